@@ -0,0 +1,215 @@
+"""Нагрузочный бенчмарк бота: настоящий `dp` против локального фейкового Bot API.
+
+Запуск:  python bench.py [--sizes 10,100,1000,10000] [--burst 2000] [--concurrency 100]
+                         [--visits 1000000] [--quick]
+
+Каждый сценарий работает на своей базе во временном DATA_DIR; ответы Telegram
+отдаёт aiohttp-сервер на 127.0.0.1, так что в замеры входит и HTTP-слой aiogram.
+Печатает пропускную способность и перцентили задержки на апдейт, затем
+разбивку по хендлерам, SQL и методам Bot API из main.metrics.
+"""
+import argparse, asyncio, itertools, os, random, shutil, sys, tempfile, time
+
+os.environ.setdefault("BOT_TOKEN", "42:BENCH")
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="gym_bench_")
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+import main
+
+NAMES = ["Анна", "Борис", "Вера", "Глеб", "Дарья", "Егор", "Жанна", "Злата", "Иван", "Кира",
+         "Лев", "Мария", "Никита", "Олег", "Полина", "Роман", "Софья", "Тимур", "Ульяна", "Фёдор"]
+CHAT = {"id": 1, "type": "private"}
+USER = {"id": 1, "is_bot": False, "first_name": "Bench"}
+
+# ---------- ФЕЙКОВЫЙ BOT API ----------
+async def fake_api(request):
+    # тело читаем целиком: загрузка документа (экспорт) тоже должна попасть в замер
+    await request.read()
+    method = request.match_info["method"].lower()
+    if method == "getme":
+        result = {"id": 42, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+    elif method.startswith(("send", "edit")):
+        result = {"message_id": 1, "date": 0, "chat": CHAT, "text": "ok"}
+    else:
+        result = True
+    return web.json_response({"ok": True, "result": result})
+
+async def start_fake_api():
+    app = web.Application(client_max_size=1 << 30)
+    app.router.add_post("/bot{token}/{method}", fake_api)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+# ---------- АПДЕЙТЫ ----------
+_ids = itertools.count(1)
+
+def message(text: str) -> Update:
+    return Update.model_validate({"update_id": next(_ids), "message": {
+        "message_id": next(_ids), "date": 0, "chat": CHAT, "from": USER, "text": text}})
+
+def callback(data: str) -> Update:
+    return Update.model_validate({"update_id": next(_ids), "callback_query": {
+        "id": str(next(_ids)), "chat_instance": "bench", "data": data, "from": USER,
+        "message": {"message_id": 1, "date": 0, "chat": CHAT, "text": "x"}}})
+
+# ---------- ДАННЫЕ ----------
+def member_name(i: int) -> str:
+    return f"{NAMES[i % len(NAMES)]} {i:05d}"
+
+async def fresh_pool(tag: str) -> main.DBPool:
+    path = os.path.join(main.DATA_DIR, f"bench_{tag}.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    pool = main.DBPool(path)
+    await pool.open()
+    return pool
+
+async def seed_members(pool: main.DBPool, n: int):
+    async with pool.write() as db:
+        await db.executemany(
+            "INSERT INTO members(name, trainings_total, remaining) VALUES(?, ?, ?)",
+            ((member_name(i), 12, 1_000_000) for i in range(n)),
+        )
+
+async def seed_visits(pool: main.DBPool, members: int, visits: int):
+    start = int(time.time()) - 2 * 365 * 86400
+    step = max(2 * 365 * 86400 // max(visits, 1), 1)
+    async with pool.write() as db:
+        await db.executemany(
+            "INSERT INTO visits(member_id, dt, status) VALUES(?, ?, ?)",
+            ((i % members + 1, start + i * step, "came" if i % 7 else "missed") for i in range(visits)),
+        )
+
+# ---------- ЗАМЕРЫ ----------
+class Run:
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.lat = []
+
+    async def feed(self, update: Update):
+        t0 = time.perf_counter()
+        await main.dp.feed_update(self.bot, update)
+        self.lat.append(time.perf_counter() - t0)
+
+    async def replay(self, updates, concurrency: int = 1):
+        """Прогоняет апдейты, держа в полёте не больше concurrency; возвращает секунды."""
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(u):
+            async with sem:
+                await self.feed(u)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(u) for u in updates))
+        return time.perf_counter() - t0
+
+def report(title: str, lat, secs: float, extra: str = ""):
+    s = sorted(lat)
+    pct = lambda q: s[min(int(q * len(s)), len(s) - 1)] * 1000
+    print(f"{title:<28} {len(s):>7} upd {len(s) / secs:>9.0f} upd/s  "
+          f"p50 {pct(0.5):7.2f}  p95 {pct(0.95):7.2f}  p99 {pct(0.99):7.2f}  max {s[-1] * 1000:8.2f} ms"
+          + (f"  {extra}" if extra else ""))
+
+# ---------- СЦЕНАРИИ ----------
+async def bench_roster(bot, mw, n: int, rounds: int):
+    """Список, страницы, карточки и /status на ростере из n учеников."""
+    pool = await fresh_pool(f"roster_{n}")
+    await seed_members(pool, n)
+    await main.reload_caches(pool)
+    mw.pool = pool
+    pages = max((n + main.ROSTER_PAGE_SIZE - 1) // main.ROSTER_PAGE_SIZE, 1)
+    rnd = random.Random(n)
+    updates = []
+    for _ in range(rounds):
+        i = rnd.randrange(n)
+        updates += [
+            message("/list"), message("/visit"),
+            callback(f"page_{rnd.randrange(pages)}"), callback("letters"),
+            callback(main.MemberCb(id=i + 1).pack()), message(f"/status {member_name(i)}"),
+        ]
+    run = Run(bot)
+    secs = await run.replay(updates)
+    report(f"roster n={n}", run.lat, secs)
+    await pool.close()
+
+async def bench_came_burst(bot, mw, members: int, burst: int, concurrency: int):
+    """Всплеск act_came_: проверяет групповой коммит под конкурентной нагрузкой."""
+    pool = await fresh_pool("burst")
+    await seed_members(pool, members)
+    await main.reload_caches(pool)
+    mw.pool = pool
+    updates = [callback(main.ActionCb(act=main.Act.came, id=i % members + 1).pack()) for i in range(burst)]
+    run = Run(bot)
+    secs = await run.replay(updates, concurrency)
+    ops, batches = pool.stats["ops"], pool.stats["batches"]
+    report(f"act_came burst c={concurrency}", run.lat, secs,
+           f"{ops / max(batches, 1):.1f} ops/txn")
+    await pool.close()
+
+async def bench_export(bot, mw, members: int, visits: int):
+    """Полная выгрузка журнала из `visits` отметок."""
+    pool = await fresh_pool("export")
+    await seed_members(pool, members)
+    t0 = time.perf_counter()
+    await seed_visits(pool, members, visits)
+    print(f"{'  seed visits':<28} {visits:>7} rows in {time.perf_counter() - t0:.1f}s")
+    await main.reload_caches(pool)
+    mw.pool = pool
+    run = Run(bot)
+    secs = await run.replay([message("/export")])
+    report(f"export visits={visits}", run.lat, secs, f"{visits / secs:,.0f} rows/s")
+    await pool.close()
+
+def print_metrics():
+    print("\nПо хендлерам / SQL / Bot API (p50 p95 p99, мс):")
+    groups = (("handler", main.metrics.handlers), ("sql", main.metrics.sql), ("api", main.metrics.api))
+    for kind, series in groups:
+        for name, t in sorted(series.items(), key=lambda kv: -kv[1].total)[:8]:
+            p50, p95, p99 = (v * 1000 for v in t.quantiles())
+            print(f"  {kind:<8} {name[:50]:<50} {t.count:>8}  {p50:7.2f} {p95:7.2f} {p99:7.2f}")
+
+async def run(args):
+    runner, base = await start_fake_api()
+    session = AiohttpSession(api=TelegramAPIServer.from_base(base))
+    bot = Bot(main.BOT_TOKEN, session=session)
+    mw = main.DBMiddleware(None)
+    main.dp.update.outer_middleware(mw)
+    main.setup_metrics(main.dp, bot)
+    print(f"DATA_DIR={main.DATA_DIR}  fake API {base}\n")
+    try:
+        for n in args.sizes:
+            await bench_roster(bot, mw, n, args.rounds)
+        await bench_came_burst(bot, mw, min(args.sizes[-1], 1000), args.burst, args.concurrency)
+        await bench_export(bot, mw, min(args.sizes[-1], 1000), args.visits)
+        print_metrics()
+    finally:
+        await session.close()
+        await runner.cleanup()
+        shutil.rmtree(main.DATA_DIR, ignore_errors=True)
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--sizes", default="10,100,1000,10000",
+                   type=lambda s: [int(x) for x in s.split(",")], help="размеры ростера")
+    p.add_argument("--rounds", type=int, default=200, help="кругов навигации на ростер")
+    p.add_argument("--burst", type=int, default=2000, help="callback-ов act_came_ во всплеске")
+    p.add_argument("--concurrency", type=int, default=100, help="апдейтов в полёте во всплеске")
+    p.add_argument("--visits", type=int, default=1_000_000, help="отметок для экспорта")
+    p.add_argument("--quick", action="store_true", help="маленькие объёмы для проверки")
+    args = p.parse_args(argv)
+    if args.quick:
+        args.sizes, args.rounds, args.burst, args.visits = [10, 1000], 20, 200, 20_000
+    return args
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(parse_args())))
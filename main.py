@@ -1,25 +1,111 @@
-import asyncio, datetime as dt, csv, os, shutil
-from aiogram import Bot, Dispatcher, F
+import time
+IMPORT_STARTED = time.perf_counter()
+import asyncio, bisect, contextvars, datetime as dt, csv, difflib, functools, glob, gzip, hmac, io, json, logging, os, re, secrets, shutil, signal, sqlite3, tempfile
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager, closing
+from enum import Enum
+from typing import Optional
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.types import (
-    Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, FSInputFile
+    Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, FSInputFile, InputFile,
+    InlineQuery, InlineQueryResultArticle, InputTextMessageContent, Update
 )
 import aiosqlite
 import calendar as calmod 
+# aiohttp.web (~25 мс импорта) нужен только вебхуку и /metrics-серверу — импортируется там
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 # ---------- НАСТРОЙКИ ----------
+# Проверяется в main(): модуль импортируется и без токена (бенчмарк, проверки)
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise RuntimeError("BOT_TOKEN env var is missing")
 
-# Персистентный каталог для БД (создай Volume в Railway и примонтируй, напр., в /data)
-DATA_DIR = "/data"
-os.makedirs(DATA_DIR, exist_ok=True)
+# Персистентный каталог для БД (создай Volume в Railway и примонтируй, напр., в /data;
+# для тестов и бенчмарков переопределяется переменной DATA_DIR)
+DATA_DIR = os.environ.get("DATA_DIR", "/data")
 
 DB = os.path.join(DATA_DIR, "gym.db")  
 
+# Сколько учеников на одной странице списка (лимит Telegram — 100 кнопок)
+ROSTER_PAGE_SIZE = int(os.environ.get("ROSTER_PAGE_SIZE", "20"))
+
+# Сколько отрисованных месяцев календаря держать в LRU
+CALENDAR_CACHE_SIZE = 24
+
+# Сколько соединений-читателей держать открытыми (писатель всегда один)
+DB_READERS = int(os.environ.get("DB_READERS", "3"))
+
+# Бэкапы: каталог, сколько хранить и как часто делать автоматически (часы, 0 — выкл.)
+BACKUP_DIR = os.path.join(DATA_DIR, "backups")
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "7"))
+BACKUP_INTERVAL_H = float(os.environ.get("BACKUP_INTERVAL_H", "24"))
+# Страниц за шаг online backup API (между шагами писатель не ждёт)
+BACKUP_PAGES_PER_STEP = 256
+# Принимаемые для /restore файлы
+BACKUP_EXTS = (".db", ".db.gz")
+
+# Архив: отметки старше ARCHIVE_AFTER_DAYS сворачиваются в месячные итоги
+# (0 — не архивировать); задача запускается раз в ARCHIVE_INTERVAL_H часов
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "365"))
+ARCHIVE_INTERVAL_H = float(os.environ.get("ARCHIVE_INTERVAL_H", "24"))
+# Сколько свободных страниц возвращать ОС за один incremental_vacuum
+VACUUM_PAGES = 2000
+
+# Напоминания тренеру: раз в сутки после REMIND_HOUR (UTC) — кому осталось
+# не больше REMIND_LOW_LEFT тренировок и кто не приходил REMIND_IDLE_DAYS дней
+REMIND_HOUR = int(os.environ.get("REMIND_HOUR", "9"))
+REMIND_LOW_LEFT = int(os.environ.get("REMIND_LOW_LEFT", "2"))
+REMIND_IDLE_DAYS = int(os.environ.get("REMIND_IDLE_DAYS", "14"))
+# Фоновые рассылки: сообщений в секунду и размер всплеска (лимит Telegram ~30/с)
+SEND_RATE = float(os.environ.get("SEND_RATE", "20"))
+SEND_BURST = int(os.environ.get("SEND_BURST", "20"))
+SEND_RETRIES = 5
+
+# FSM (диалоги): через сколько секунд сбрасывать изменения в БД
+# и сколько записей держать в памяти
+FSM_FLUSH_S = float(os.environ.get("FSM_FLUSH_S", "2"))
+FSM_CACHE_SIZE = 10000
+
+# Групповой коммит: сколько изменений максимум в одной транзакции
+# и сколько ждать попутчиков после первого (мс)
+WRITE_BATCH_MAX = int(os.environ.get("WRITE_BATCH_MAX", "64"))
+WRITE_BATCH_DELAY_MS = float(os.environ.get("WRITE_BATCH_DELAY_MS", "5"))
+
+# Telegram id администраторов через запятую (пусто — служебные команды доступны всем,
+# кроме /tenants: она показывает чужие чаты и без ADMIN_IDS закрыта)
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").replace(",", " ").split()}
+
+# Метрики: по скольким последним замерам считать перцентили
+# и на каком порту отдавать их в формате Prometheus (0 — не поднимать)
+METRICS_WINDOW = int(os.environ.get("METRICS_WINDOW", "1024"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+# Вебхук вместо long polling: задай WEBHOOK_URL (публичный https-адрес бота).
+# Без WEBHOOK_SECRET секрет генерируется заново при каждом запуске.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", os.environ.get("WEBHOOK_PORT", "8080")))
+# Сколько апдейтов обрабатывать одновременно и сколько ждать их при остановке (с)
+WEBHOOK_MAX_INFLIGHT = int(os.environ.get("WEBHOOK_MAX_INFLIGHT", "64"))
+WEBHOOK_DRAIN_S = float(os.environ.get("WEBHOOK_DRAIN_S", "30"))
+
+# Арендаторы: MULTI_TENANT=1 — у каждого чата (тренера) своя база в TENANTS_DIR.
+# LEGACY_TENANT — id чата, который остаётся на прежней общей базе DB.
+MULTI_TENANT = os.environ.get("MULTI_TENANT", "0") == "1"
+TENANTS_DIR = os.path.join(DATA_DIR, "tenants")
+LEGACY_TENANT = int(os.environ.get("LEGACY_TENANT", "0"))
+# Сколько баз держать открытыми и через сколько минут простоя закрывать
+TENANTS_MAX_OPEN = int(os.environ.get("TENANTS_MAX_OPEN", "32"))
+TENANT_IDLE_MIN = float(os.environ.get("TENANT_IDLE_MIN", "30"))
+
 # ---------- СХЕМА БД ----------
 CREATE_SQL = """
 CREATE TABLE IF NOT EXISTS members(
@@ -38,94 +124,1920 @@ CREATE TABLE IF NOT EXISTS visits(
 );
 """
 
-bot = Bot(BOT_TOKEN)
+# Миграции поверх CREATE_SQL; номер применённой хранится в PRAGMA user_version.
+# Новая миграция — только добавлением в конец списка.
+MIGRATIONS = [
+    # 1: время в секундах epoch (INTEGER), внешний ключ и индексы журнала
+    """
+    CREATE TABLE members_new(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      name TEXT UNIQUE,
+      trainings_total INTEGER DEFAULT 12,
+      remaining INTEGER DEFAULT 12,
+      last_visit_at INTEGER,
+      vacation INTEGER DEFAULT 0
+    );
+    INSERT INTO members_new(id, name, trainings_total, remaining, last_visit_at, vacation)
+      SELECT id, name, trainings_total, remaining,
+             CAST(strftime('%s', last_visit_at) AS INTEGER), vacation
+      FROM members;
+    DROP TABLE members;
+    ALTER TABLE members_new RENAME TO members;
+
+    CREATE TABLE visits_new(
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      member_id INTEGER NOT NULL REFERENCES members(id) ON DELETE CASCADE,
+      dt INTEGER NOT NULL,
+      status TEXT NOT NULL
+    );
+    INSERT INTO visits_new(id, member_id, dt, status)
+      SELECT id, member_id, COALESCE(CAST(strftime('%s', dt) AS INTEGER), 0), status
+      FROM visits
+      WHERE member_id IN (SELECT id FROM members);
+    DROP TABLE visits;
+    ALTER TABLE visits_new RENAME TO visits;
+    CREATE INDEX visits_member ON visits(member_id, id);
+    CREATE INDEX visits_dt ON visits(dt);
+    """,
+    # 2: служебные значения (водяной знак экспорта и т.п.)
+    """
+    CREATE TABLE meta(
+      key TEXT PRIMARY KEY,
+      value
+    );
+    """,
+    # 3: суточные сводки для /stats (день = секунды epoch // 86400, UTC)
+    """
+    CREATE TABLE daily_stats(
+      member_id INTEGER NOT NULL REFERENCES members(id) ON DELETE CASCADE,
+      day INTEGER NOT NULL,
+      came INTEGER NOT NULL DEFAULT 0,
+      missed INTEGER NOT NULL DEFAULT 0,
+      charged INTEGER NOT NULL DEFAULT 0,
+      renewed INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY(member_id, day)
+    ) WITHOUT ROWID;
+    CREATE INDEX daily_stats_day ON daily_stats(day);
+    INSERT INTO daily_stats(member_id, day, came, missed, charged)
+      SELECT member_id, dt / 86400, SUM(status = 'came'), SUM(status = 'missed'), SUM(status = 'came')
+      FROM visits GROUP BY member_id, dt / 86400;
+    """,
+    # 4: месячные итоги архивированных отметок (month — начало месяца, секунды epoch)
+    """
+    CREATE TABLE visits_archive(
+      member_id INTEGER NOT NULL REFERENCES members(id) ON DELETE CASCADE,
+      month INTEGER NOT NULL,
+      came INTEGER NOT NULL DEFAULT 0,
+      missed INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY(member_id, month)
+    ) WITHOUT ROWID;
+    CREATE INDEX visits_archive_month ON visits_archive(month);
+    """,
+    # 5: частичные индексы для напоминаний (запросы обязаны содержать vacation = 0)
+    """
+    CREATE INDEX members_low_left ON members(remaining) WHERE vacation = 0;
+    CREATE INDEX members_last_visit ON members(last_visit_at) WHERE vacation = 0;
+    """,
+    # 6: состояния FSM (диалог «Добавить», групповая отметка); data — JSON
+    """
+    CREATE TABLE fsm(
+      chat_id INTEGER NOT NULL,
+      user_id INTEGER NOT NULL,
+      thread_id INTEGER NOT NULL DEFAULT 0,
+      destiny TEXT NOT NULL DEFAULT 'default',
+      state TEXT,
+      data TEXT NOT NULL DEFAULT '{}',
+      PRIMARY KEY(chat_id, user_id, thread_id, destiny)
+    ) WITHOUT ROWID;
+    """,
+    # 7: списана ли тренировка за отметку (в отпуске — нет); /undo возвращает только списанное.
+    # Для старых отметок отпуск неизвестен — считаем списанными, как и сводка из миграции 3.
+    """
+    ALTER TABLE visits ADD COLUMN charged INTEGER NOT NULL DEFAULT 0;
+    UPDATE visits SET charged = (status = 'came');
+    """,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+async def migrate(db) -> int:
+    """Доводит схему до SCHEMA_VERSION; возвращает версию до миграции."""
+    await db.executescript(CREATE_SQL)
+    async with db.execute("PRAGMA user_version") as c:
+        (version,) = await c.fetchone()
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"DB schema v{version} is newer than the bot (v{SCHEMA_VERSION})")
+    for target in range(version + 1, SCHEMA_VERSION + 1):
+        # пересборка таблиц требует выключенных внешних ключей
+        await db.execute("PRAGMA foreign_keys=OFF")
+        try:
+            await db.executescript(
+                f"BEGIN;\n{MIGRATIONS[target - 1]}\nPRAGMA user_version={target};\nCOMMIT;"
+            )
+        except Exception:
+            await db.rollback()
+            raise
+        finally:
+            await db.execute("PRAGMA foreign_keys=ON")
+    return version
+
+# Применяются к каждому соединению пула
+PRAGMAS = (
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+log = logging.getLogger("gym")
+
 dp = Dispatcher()
 
-async def ensure_db():
-    async with aiosqlite.connect(DB) as db:
-        await db.executescript(CREATE_SQL)
-        await db.commit()
+# ---------- МЕТРИКИ ----------
+QUANTILES = (0.5, 0.95, 0.99)
+
+class Timing:
+    """Счётчик, сумма и окно последних замеров (секунды) для перцентилей."""
+
+    __slots__ = ("count", "total", "window")
+
+    def __init__(self, window: int = METRICS_WINDOW):
+        self.count = 0
+        self.total = 0.0
+        self.window = deque(maxlen=max(window, 1))
+
+    def observe(self, secs: float):
+        self.count += 1
+        self.total += secs
+        self.window.append(secs)
+
+    def quantiles(self, qs=QUANTILES):
+        if not self.window:
+            return [0.0] * len(qs)
+        s = sorted(self.window)
+        return [s[min(int(q * len(s)), len(s) - 1)] for q in qs]
+
+class Metrics:
+    """Задержки апдейтов, хендлеров, SQL и запросов к Bot API; живут до перезапуска."""
+
+    def __init__(self):
+        self.updates = defaultdict(Timing)    # тип апдейта -> полный цикл обработки
+        self.handlers = defaultdict(Timing)   # имя хендлера
+        self.sql = defaultdict(Timing)        # выражение (сокращённое)
+        self.api = defaultdict(Timing)        # метод Bot API
+        self.callbacks = Counter()            # префикс callback_data
+        self.errors = Counter()               # имя хендлера -> исключения
+        self.startup = {}                     # фаза запуска -> секунды
+        self.started = time.time()
+
+metrics = Metrics()
+
+@functools.lru_cache(maxsize=512)
+def sql_label(sql: str) -> str:
+    """Метка выражения для метрик: пробелы схлопнуты, длина ограничена."""
+    return " ".join(sql.split())[:60]
+
+def callback_prefix(data) -> str:
+    # m:12 -> m, a:c:12 -> a, page_3 -> page, cal:2024-05-01 -> cal
+    return re.match(r"[a-z]*", data or "").group() or "?"
+
+class TimedConnection(aiosqlite.Connection):
+    """aiosqlite-соединение, замеряющее execute/executemany/executescript."""
+
+    @aiosqlite.context.contextmanager
+    async def execute(self, sql, parameters=None):
+        t0 = time.perf_counter()
+        try:
+            return await super().execute(sql, parameters)
+        finally:
+            metrics.sql[sql_label(sql)].observe(time.perf_counter() - t0)
+
+    @aiosqlite.context.contextmanager
+    async def executemany(self, sql, parameters):
+        t0 = time.perf_counter()
+        try:
+            return await super().executemany(sql, parameters)
+        finally:
+            metrics.sql[sql_label(sql)].observe(time.perf_counter() - t0)
+
+    @aiosqlite.context.contextmanager
+    async def executescript(self, sql_script):
+        t0 = time.perf_counter()
+        try:
+            return await super().executescript(sql_script)
+        finally:
+            metrics.sql["<script>"].observe(time.perf_counter() - t0)
+
+def connect_timed(path: str, **kwargs) -> TimedConnection:
+    """Как aiosqlite.connect(), но соединение пишет время запросов в metrics.sql."""
+    return TimedConnection(lambda: sqlite3.connect(path, **kwargs), 64)
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний: время полного цикла апдейта по типу и счётчик callback-префиксов."""
+
+    async def __call__(self, handler, event, data):
+        try:
+            kind = event.event_type
+        except Exception:
+            kind = "unknown"
+        if kind == "callback_query":
+            metrics.callbacks[callback_prefix(event.callback_query.data)] += 1
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.updates[kind].observe(time.perf_counter() - t0)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний: время конкретного хендлера (по имени функции) и его ошибки."""
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.errors[name] += 1
+            raise
+        finally:
+            metrics.handlers[name].observe(time.perf_counter() - t0)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Время запросов к Telegram Bot API по методам."""
+
+    async def __call__(self, make_request, bot, method):
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            metrics.api[type(method).__name__].observe(time.perf_counter() - t0)
+
+def setup_metrics(dp: Dispatcher, bot: Bot):
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    for observer in (dp.message, dp.callback_query, dp.inline_query):
+        observer.middleware(HandlerMetricsMiddleware())
+    bot.session.middleware(ApiMetricsMiddleware())
+
+def is_admin(user, strict: bool = False) -> bool:
+    """strict — без ADMIN_IDS отказать (для команд, раскрывающих данные других чатов)."""
+    if not ADMIN_IDS:
+        return not strict
+    return user is not None and user.id in ADMIN_IDS
+
+def _prom_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus_text(pools=(), tenant_pools=None, fsm=None) -> str:
+    """Все метрики в текстовом формате Prometheus 0.0.4; кэши и запись — сумма по pools.
+
+    tenant_pools (TenantPools) и fsm (SQLiteStorage) добавляют свои счётчики событий.
+    """
+    lines = []
+
+    def summary(name, help_text, label, series):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} summary")
+        for key, t in sorted(series.items()):
+            lv = _prom_label(key)
+            for q, v in zip(QUANTILES, t.quantiles()):
+                lines.append(f'{name}{{{label}="{lv}",quantile="{q}"}} {v:.6f}')
+            lines.append(f'{name}_sum{{{label}="{lv}"}} {t.total:.6f}')
+            lines.append(f'{name}_count{{{label}="{lv}"}} {t.count}')
+
+    def counter(name, help_text, labels, rows):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for values, n in rows:
+            lv = ",".join(f'{l}="{_prom_label(v)}"' for l, v in zip(labels, values))
+            lines.append(f"{name}{{{lv}}} {n}")
+
+    summary("gym_update_seconds", "Full update processing time", "type", metrics.updates)
+    summary("gym_handler_seconds", "Handler execution time", "handler", metrics.handlers)
+    summary("gym_sql_seconds", "SQL statement time", "stmt", metrics.sql)
+    summary("gym_api_seconds", "Telegram Bot API request time", "method", metrics.api)
+    counter("gym_callbacks_total", "Callback queries by data prefix", ("prefix",),
+            (((k,), n) for k, n in sorted(metrics.callbacks.items())))
+    counter("gym_handler_errors_total", "Handler exceptions", ("handler",),
+            (((k,), n) for k, n in sorted(metrics.errors.items())))
+    members, calendar, writes = Counter(), Counter(), Counter()
+    for pool in pools:
+        members.update(pool.members.stats)
+        calendar.update(pool.calendar.stats)
+        writes.update(pool.stats)
+    caches = [(("members", k), n) for k, n in sorted(members.items())]
+    caches += [(("calendar", k), n) for k, n in sorted(calendar.items())]
+    counter("gym_cache_events_total", "Cache hits and misses", ("cache", "event"), caches)
+    counter("gym_write_total", "Group commit batches and operations", ("kind",),
+            (((k,), n) for k, n in sorted(writes.items())))
+    counter("gym_send_total", "Background messages by outcome", ("status",),
+            (((k,), n) for k, n in sorted(send_queue.stats.items())))
+    if tenant_pools is not None:
+        counter("gym_tenant_pool_events_total", "Tenant pool LRU hits, opens and evictions", ("event",),
+                (((k,), n) for k, n in sorted(tenant_pools.stats.items())))
+    if fsm is not None:
+        counter("gym_fsm_events_total", "FSM storage cache hits, misses and flushes", ("event",),
+                (((k,), n) for k, n in sorted(fsm.stats.items())))
+    lines.append("# TYPE gym_members gauge")
+    lines.append(f"gym_members {sum(len(p.members.by_id) for p in pools)}")
+    lines.append("# TYPE gym_open_databases gauge")
+    lines.append(f"gym_open_databases {len(pools)}")
+    lines.append("# TYPE gym_startup_seconds gauge")
+    lines += [f'gym_startup_seconds{{phase="{k}"}} {v:.6f}' for k, v in metrics.startup.items()]
+    lines.append("# TYPE gym_uptime_seconds gauge")
+    lines.append(f"gym_uptime_seconds {time.time() - metrics.started:.0f}")
+    return "\n".join(lines) + "\n"
+
+async def start_metrics_server(tenants, fsm=None, host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Поднимает GET /metrics для Prometheus; возвращает runner для cleanup()."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(
+            body=prometheus_text(tenants.open_pools(), tenants, fsm).encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("metrics on http://%s:%s/metrics", host, port)
+    return runner
+
+# ---------- ПУЛ СОЕДИНЕНИЙ ----------
+class DBPool:
+    """Долгоживущие соединения к БД: один писатель и несколько читателей (WAL).
+
+    Открывается TenantPools — по пулу на базу арендатора, схема применяется
+    при open(). Хендлеры получают пул базы своего чата через TenantMiddleware
+    (аргумент `pool`); DBMiddleware с одним пулом — для бенчмарка.
+
+    Все изменения идут через submit(): фоновая задача-писатель собирает
+    операции, пришедшие в пределах max_delay, в одну транзакцию (один fsync)
+    и возвращает каждому вызывающему его результат.
+    """
+
+    def __init__(self, path: str, readers: int = DB_READERS,
+                 max_batch: int = WRITE_BATCH_MAX, max_delay_ms: float = WRITE_BATCH_DELAY_MS):
+        self.path = path
+        self.readers_count = max(readers, 1)
+        self.max_batch = max(max_batch, 1)
+        self.max_delay = max_delay_ms / 1000
+        self.stats = Counter()
+        # кэши у каждой базы свои; хендлеры видят их как members_cache / calendar_cache
+        self.members = MemberCache()
+        self.calendar = CalendarCache()
+        self.users = 0
+        self.last_used = time.monotonic()
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._writer_task = None
+        self._conns = []
+
+    async def _connect(self, readonly: bool = False):
+        # cached_statements — кэш подготовленных выражений sqlite3
+        db = await connect_timed(self.path, cached_statements=256)
+        for pragma in PRAGMAS:
+            await db.execute(pragma)
+        if readonly:
+            await db.execute("PRAGMA query_only=ON")
+        self._conns.append(db)
+        return db
+
+    async def _open_connections(self):
+        self._writer = await self._connect()
+        # на новой базе включится сразу, на старой — после VACUUM в compact_db()
+        await self._writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await self._writer.execute("PRAGMA journal_mode=WAL")
+        await migrate(self._writer)
+        # у каждого соединения свой поток — открываем читателей одновременно
+        readers = await asyncio.gather(*(self._connect(readonly=True) for _ in range(self.readers_count)))
+        for db in readers:
+            self._readers.put_nowait(db)
+
+    async def _close_connections(self):
+        # очередь читателей та же самая: в ней могут ждать хендлеры
+        while not self._readers.empty():
+            self._readers.get_nowait()
+        # писатель закрывается последним — он делает checkpoint WAL
+        for db in reversed(self._conns):
+            await db.close()
+        self._conns.clear()
+        self._writer = None
+
+    async def open(self):
+        await self._open_connections()
+        self._writer_task = asyncio.create_task(self._writer_loop())
+
+    async def close(self):
+        # сначала дописываем всё, что уже стоит в очереди
+        if self._writer_task:
+            if not self._writer_task.done():
+                self._queue.put_nowait(None)
+            try:
+                await self._writer_task
+            except Exception:
+                log.exception("writer of %s failed", self.path)
+            self._writer_task = None
+        # писателя больше нет — оставшихся в очереди не оставляем ждать вечно
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None and not item[1].done():
+                item[1].set_exception(RuntimeError(f"DB pool {self.path} is closed"))
+        await self._close_connections()
+
+    async def swap(self, new_path: str):
+        """Подменяет файл БД на new_path без остановки бота.
+
+        Под блокировкой писателя дожидается возврата всех читателей,
+        закрывает соединения, переименовывает файл и открывает их заново.
+        Если новая база не открылась, возвращает прежнюю.
+        """
+        async with self._write_lock:
+            for _ in range(self.readers_count):
+                await self._readers.get()
+            await self._close_connections()
+            prev_path = self.path + ".pre_restore"
+            os.replace(self.path, prev_path)
+            os.replace(new_path, self.path)
+            try:
+                await self._open_connections()
+            except Exception:
+                await self._close_connections()
+                os.replace(prev_path, self.path)
+                await self._open_connections()
+                raise
+            finally:
+                self.members.invalidate()
+            os.remove(prev_path)
+
+    @asynccontextmanager
+    async def read(self):
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def write(self):
+        """Эксклюзивный доступ к писателю; commit при выходе, rollback при ошибке."""
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                # кэш мог получить записи из откатанной транзакции
+                await self._reload_members(self._writer)
+                raise
+            await self._writer.commit()
+
+    async def _reload_members(self, db):
+        """Перечитывает кэш учеников из db под блокировкой писателя.
+
+        Просто сбросить мало: промахи get_member_by_* не кладут строки
+        в незагруженный кэш, и он остался бы пустым до /list.
+        """
+        self.members.invalidate()
+        try:
+            await self.members.load(db)
+        except Exception:
+            log.exception("reload of member cache failed: %s", self.path)
+
+    async def submit(self, fn):
+        """Ставит изменение `await fn(db)` в очередь группового коммита.
+
+        Возвращает результат fn после коммита батча; исключение fn
+        откатывает только эту операцию и пробрасывается вызывающему.
+        """
+        if self._writer_task is None or self._writer_task.done():
+            raise RuntimeError(f"DB pool {self.path} is not open")
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((fn, fut))
+        return await fut
+
+    async def _writer_loop(self):
+        # операции в fn(db) обращаются к members_cache — это кэш этой базы
+        current_pool.set(self)
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                await self._run_batch(batch)
+            except Exception as e:
+                # сбой вне операций (rollback, соединение): батч проваливаем, писатель живёт дальше
+                log.exception("write batch on %s failed", self.path)
+                for _fn, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+    async def _run_batch(self, batch):
+        results = []
+        stale = False
+        async with self._write_lock:
+            # писатель мог смениться при swap(), берём его только под блокировкой
+            db = self._writer
+            try:
+                await db.execute("BEGIN")
+                for fn, fut in batch:
+                    # savepoint на операцию: ошибка одной не губит остальные
+                    await db.execute("SAVEPOINT op")
+                    version = self.members.version
+                    try:
+                        res = await fn(db)
+                    except Exception as e:
+                        await db.execute("ROLLBACK TO op")
+                        await db.execute("RELEASE op")
+                        # дубль /add падает на INSERT до put — кэш цел, не трогаем
+                        stale |= self.members.version != version
+                        results.append((fut, None, e))
+                    else:
+                        await db.execute("RELEASE op")
+                        results.append((fut, res, None))
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                stale = True
+                results = [(fut, None, e) for _fn, fut in batch]
+            if stale:
+                await self._reload_members(db)
+        self.stats["batches"] += 1
+        self.stats["ops"] += len(batch)
+        for fut, res, err in results:
+            if fut.done():
+                continue
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+# Пул базы, с которой работает текущий апдейт или задача
+current_pool: contextvars.ContextVar = contextvars.ContextVar("current_pool")
+
+class DBMiddleware(BaseMiddleware):
+    """Прокидывает один заданный пул в хендлеры, минуя арендаторов (bench.py)."""
+
+    def __init__(self, pool: DBPool):
+        self.pool = pool
+
+    async def __call__(self, handler, event, data):
+        data["pool"] = self.pool
+        token = current_pool.set(self.pool)
+        try:
+            return await handler(event, data)
+        finally:
+            current_pool.reset(token)
+
+# ---------- АРЕНДАТОРЫ ----------
+class TenantPools:
+    """Пулы баз по арендаторам: LRU на max_open открытых, простаивающие закрываются.
+
+    Арендатор — чат тренера (для inline-запросов — пользователь). Без MULTI_TENANT
+    все попадают в общую базу DB. Пул, которым сейчас пользуется хендлер,
+    не выселяется, даже если LRU переполнен.
+    """
+
+    def __init__(self, multi: bool = MULTI_TENANT, max_open: int = TENANTS_MAX_OPEN,
+                 idle_min: float = TENANT_IDLE_MIN):
+        self.multi = multi
+        self.max_open = max(max_open, 1)
+        self.idle_s = idle_min * 60
+        self.stats = Counter()
+        self._pools = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    def key(self, tenant_id: int) -> int:
+        """0 — общая база DB."""
+        return tenant_id if self.multi and tenant_id != LEGACY_TENANT else 0
+
+    def path(self, key: int) -> str:
+        return DB if key == 0 else os.path.join(TENANTS_DIR, f"{key}.db")
+
+    def known(self):
+        """Ключи всех арендаторов, у которых есть файл базы."""
+        keys = [0] if os.path.exists(DB) or not self.multi else []
+        if self.multi:
+            for path in glob.glob(os.path.join(TENANTS_DIR, "*.db")):
+                stem = os.path.basename(path)[:-3]
+                if stem.lstrip("-").isdigit():
+                    keys.append(int(stem))
+        return keys
+
+    def open_pools(self):
+        return list(self._pools.values())
+
+    def is_open(self, key: int) -> bool:
+        return key in self._pools
+
+    async def get(self, tenant_id: int) -> DBPool:
+        key = self.key(tenant_id)
+        pool = self._pools.get(key)
+        if pool is None:
+            async with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = await self._open(key)
+        else:
+            self.stats["hit"] += 1
+        self._pools.move_to_end(key)
+        pool.last_used = time.monotonic()
+        return pool
+
+    @asynccontextmanager
+    async def use(self, tenant_id: int):
+        """Пул арендатора на время работы с ним; выставляет current_pool."""
+        pool = await self.get(tenant_id)
+        pool.users += 1
+        token = current_pool.set(pool)
+        try:
+            yield pool
+        finally:
+            current_pool.reset(token)
+            pool.users -= 1
+            pool.last_used = time.monotonic()
+
+    async def _open(self, key: int) -> DBPool:
+        if key:
+            os.makedirs(TENANTS_DIR, exist_ok=True)
+        pool = DBPool(self.path(key))
+        await pool.open()
+        await reload_caches(pool)
+        self._pools[key] = pool
+        self.stats["opened"] += 1
+        # переполнение LRU: закрываем самые давние свободные
+        for old_key, old in list(self._pools.items()):
+            if len(self._pools) <= self.max_open:
+                break
+            if old_key != key and not old.users:
+                await self._close(old_key)
+        return pool
+
+    async def _close(self, key: int):
+        pool = self._pools.pop(key)
+        self.stats["evicted"] += 1
+        # очередь записи дописывается в close()
+        await pool.close()
+
+    async def evict_idle(self) -> int:
+        deadline = time.monotonic() - self.idle_s
+        idle = [k for k, p in self._pools.items() if p.last_used < deadline and not p.users]
+        for key in idle:
+            await self._close(key)
+        return len(idle)
+
+    async def reaper(self):
+        while True:
+            await asyncio.sleep(max(self.idle_s / 2, 1))
+            try:
+                if n := await self.evict_idle():
+                    log.info("tenants: closed %d idle databases", n)
+            except Exception:
+                log.exception("tenant eviction failed")
+
+    async def close(self):
+        for key in list(self._pools):
+            await self._close(key)
+
+class TenantMiddleware(BaseMiddleware):
+    """Выбирает базу арендатора по чату апдейта и прокидывает её пул в хендлеры."""
+
+    def __init__(self, tenants: TenantPools):
+        self.tenants = tenants
+
+    async def __call__(self, handler, event, data):
+        chat, user = data.get("event_chat"), data.get("event_from_user")
+        tenant_id = chat.id if chat else user.id if user else 0
+        async with self.tenants.use(tenant_id) as pool:
+            data["pool"] = pool
+            data["tenants"] = self.tenants
+            return await handler(event, data)
+
+# ---------- FSM ----------
+FSM_SELECT_SQL = "SELECT state, data FROM fsm WHERE chat_id=? AND user_id=? AND thread_id=? AND destiny=?"
+FSM_UPSERT_SQL = """
+INSERT INTO fsm(chat_id, user_id, thread_id, destiny, state, data) VALUES(?, ?, ?, ?, ?, ?)
+ON CONFLICT(chat_id, user_id, thread_id, destiny) DO UPDATE SET
+  state = excluded.state,
+  data = excluded.data
+"""
+FSM_DELETE_SQL = "DELETE FROM fsm WHERE chat_id=? AND user_id=? AND thread_id=? AND destiny=?"
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm базы арендатора с write-back кэшем.
+
+    Чтение идёт из памяти (промах — один SELECT). Изменения помечаются
+    грязными и уходят одной пачкой через групповой коммит через FSM_FLUSH_S
+    секунд после первого из них, а также при остановке (close()).
+    Чистые записи вытесняются по LRU сверх max_size.
+    """
+
+    def __init__(self, tenants: TenantPools, flush_s: float = FSM_FLUSH_S, max_size: int = FSM_CACHE_SIZE):
+        self.tenants = tenants
+        self.flush_s = flush_s
+        self.max_size = max(max_size, 1)
+        self.stats = Counter()
+        self._cache = OrderedDict()  # (chat, user, thread, destiny) -> [state, data]
+        self._dirty = set()
+        self._flusher = None
+        self._closed = False
+
+    @staticmethod
+    def _key(key: StorageKey):
+        return (key.chat_id, key.user_id, key.thread_id or 0, key.destiny)
+
+    async def _entry(self, key: StorageKey):
+        k = self._key(key)
+        entry = self._cache.get(k)
+        if entry is not None:
+            self._cache.move_to_end(k)
+            self.stats["hit"] += 1
+            return k, entry
+        self.stats["miss"] += 1
+        # use(), а не get(): FSM-middleware идёт раньше TenantMiddleware,
+        # и без закрепления LRU мог бы закрыть пул посреди чтения
+        async with self.tenants.use(key.chat_id) as pool, pool.read() as db:
+            async with db.execute(FSM_SELECT_SQL, k) as c:
+                row = await c.fetchone()
+        # пока читали, запись могла появиться — она свежее
+        entry = self._cache.setdefault(k, [row[0], json.loads(row[1])] if row else [None, {}])
+        while len(self._cache) > self.max_size:
+            clean = next((old for old in self._cache if old not in self._dirty), None)
+            if clean is None:
+                break
+            del self._cache[clean]
+        return k, entry
+
+    def _mark(self, k):
+        self._dirty.add(k)
+        self._schedule()
+
+    def _schedule(self):
+        # из самого флашера (повтор после сбоя) — текущая задача ещё не done()
+        running = self._flusher is not None and not self._flusher.done()
+        if not self._closed and (not running or self._flusher is asyncio.current_task()):
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_s)
+        try:
+            await self.flush()
+        except Exception:
+            log.exception("FSM flush failed")
+
+    async def set_state(self, key: StorageKey, state=None):
+        k, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._mark(k)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._entry(key))[1][0]
+
+    async def set_data(self, key: StorageKey, data):
+        k, entry = await self._entry(key)
+        entry[1] = dict(data)
+        self._mark(k)
+
+    async def get_data(self, key: StorageKey):
+        return dict((await self._entry(key))[1][1])
+
+    async def flush(self):
+        """Записывает грязные состояния; пустые удаляются из таблицы.
+
+        Сбой одного арендатора не мешает остальным: его записи снова
+        помечаются грязными и уходят следующим флашем, первая ошибка
+        пробрасывается после обхода всех.
+        """
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        by_tenant = defaultdict(lambda: ([], []))
+        for k in dirty:
+            state, data = self._cache[k]
+            upserts, deletes = by_tenant[self.tenants.key(k[0])]
+            if state is None and not data:
+                deletes.append(k)
+            else:
+                upserts.append(k + (state, json.dumps(data, ensure_ascii=False)))
+        error = None
+        for tenant, (upserts, deletes) in by_tenant.items():
+            try:
+                async with self.tenants.use(tenant) as pool:
+                    await pool.submit(lambda db, u=upserts, d=deletes: self._write(db, u, d))
+            except Exception as e:
+                self._dirty.update(row[:4] for row in upserts + deletes)
+                self.stats["flush_errors"] += 1
+                error = error or e
+        self.stats["flushes"] += 1
+        if error is not None:
+            self._schedule()
+            raise error
+
+    @staticmethod
+    async def _write(db, upserts, deletes):
+        await db.executemany(FSM_UPSERT_SQL, upserts)
+        await db.executemany(FSM_DELETE_SQL, deletes)
+
+    async def close(self):
+        self._closed = True
+        if self._flusher and not self._flusher.done():
+            self._flusher.cancel()
+        await self.flush()
+
+# ---------- КЭШ УЧЕНИКОВ ----------
+# Кириллица -> латиница, чтобы «Роман» и «Roman» давали один ключ
+TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh",
+    "з": "z", "и": "i", "й": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o",
+    "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "h", "ц": "ts",
+    "ч": "ch", "ш": "sh", "щ": "sch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu",
+    "я": "ya", "і": "i", "ї": "i", "є": "e",
+})
+
+def name_key(name: str) -> str:
+    """Ключ для нечёткого поиска: регистр, ё/е и раскладка письма не важны."""
+    return "".join(ch for ch in name.casefold().translate(TRANSLIT) if ch.isalnum())
+
+def trigrams(key: str) -> set:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+# Ниже этого сходства (difflib.ratio по ключам) кандидата не предлагаем
+FUZZY_MIN_SCORE = 0.6
+class MemberCache:
+    """Копия таблицы members в памяти процесса (write-through).
+
+    Строки хранятся в том же виде, что отдают хелперы:
+    (id, name, remaining, trainings_total, vacation).
+    Страницы клавиатуры (на кнопках только имена) и порядок по имени живут
+    до изменения состава или имён; текст /list — до любого изменения строки.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.by_id = {}
+        self.by_name = {}
+        self._grams = {}
+        self._index = {}
+        self.stats = Counter()
+        self.version = 0
+        self.names_version = 0
+        self._changed()
+
+    def _changed(self, names: bool = True):
+        # version растёт на каждом изменении: писатель по нему видит,
+        # успела ли откатанная операция записать в кэш
+        self.version += 1
+        self._sorted = None
+        self._list_text = None
+        if names:
+            # добавление, переименование, перечитывание; остаток и отпуск сюда не доходят
+            self.names_version += 1
+            self._order = None
+            self._folded = None
+            self._letters = None
+            self._pages = {}
+
+    async def load(self, db):
+        async with db.execute(
+            "SELECT id, name, remaining, trainings_total, vacation FROM members"
+        ) as c:
+            rows = await c.fetchall()
+        self.invalidate()
+        for row in rows:
+            self.put(row)
+        self.loaded = True
+
+    def invalidate(self):
+        self.loaded = False
+        self.by_id = {}
+        self.by_name = {}
+        self._grams = {}
+        self._index = {}
+        self._changed()
+
+    def put(self, row):
+        row = tuple(row)
+        old = self.by_id.get(row[0])
+        if old and old[1] != row[1]:
+            self.by_name.pop(old[1], None)
+        if not old or old[1] != row[1]:
+            self._index_name(row[0], row[1])
+        self.by_id[row[0]] = row
+        self.by_name[row[1]] = row[0]
+        self._changed(names=not old or old[1] != row[1])
+
+    def _index_name(self, member_id: int, name: str):
+        # триграммный индекс: триграмма -> множество id
+        for gram in self._grams.get(member_id, ()):
+            ids = self._index[gram]
+            ids.discard(member_id)
+            if not ids:
+                del self._index[gram]
+        grams = self._grams[member_id] = trigrams(name_key(name or ""))
+        for gram in grams:
+            self._index.setdefault(gram, set()).add(member_id)
+
+    def fuzzy(self, name: str, limit: int = 5):
+        """Похожие по имени ученики: [(сходство 0..1, строка)] по убыванию сходства.
+
+        Кандидаты — все, у кого есть общая триграмма с запросом;
+        их ранжирует difflib по нормализованным ключам.
+        """
+        key = name_key(name)
+        candidates = set()
+        for gram in trigrams(key):
+            candidates |= self._index.get(gram, set())
+        scored = []
+        matcher = difflib.SequenceMatcher(b=key)
+        for member_id in candidates:
+            row = self.by_id[member_id]
+            matcher.set_seq1(name_key(row[1]))
+            score = matcher.ratio()
+            if score >= FUZZY_MIN_SCORE:
+                scored.append((score, row))
+        scored.sort(key=lambda item: (-item[0], item[1][1]))
+        return scored[:limit]
+
+    def all(self):
+        if self._sorted is None:
+            if self._order is None:
+                # порядок как у ORDER BY name (BINARY == порядок кодовых точек)
+                self._order = [row[0] for row in sorted(self.by_id.values(), key=lambda r: r[1])]
+            self._sorted = [self.by_id[member_id] for member_id in self._order]
+        return self._sorted
+
+    def search(self, prefix: str, limit: int = None):
+        """Ученики, чьё имя начинается с prefix (без учёта регистра), по алфавиту."""
+        if self._folded is None:
+            self._folded = sorted((row[1].casefold(), row[0]) for row in self.by_id.values())
+        key = prefix.casefold()
+        out = []
+        i = bisect.bisect_left(self._folded, (key,))
+        while i < len(self._folded) and self._folded[i][0].startswith(key):
+            if limit is not None and len(out) >= limit:
+                break
+            out.append(self.by_id[self._folded[i][1]])
+            i += 1
+        return out
+
+    def letters(self):
+        if self._letters is None:
+            self._letters = sorted({row[1][:1].upper() for row in self.by_id.values() if row[1]})
+        return self._letters
+
+    def keyboard(self, page: int = 0, letter: str = None) -> InlineKeyboardMarkup:
+        """Страница списка (целиком или только на букву letter)."""
+        key = (letter, page)
+        kb = self._pages.get(key)
+        if kb is None:
+            self.stats["render_miss"] += 1
+            members = self.search(letter) if letter else self.all()
+            kb = self._pages[key] = members_keyboard(members, page, letter)
+        else:
+            self.stats["render_hit"] += 1
+        return kb
+
+    def list_text(self) -> str:
+        if self._list_text is None:
+            self.stats["render_miss"] += 1
+            self._list_text = members_list_text(self.all())
+        else:
+            self.stats["render_hit"] += 1
+        return self._list_text
+
+class TenantLocal:
+    """Атрибут `attr` пула из current_pool: кэш базы, с которой идёт работа."""
+
+    __slots__ = ("_attr",)
+
+    def __init__(self, attr: str):
+        self._attr = attr
+
+    def __getattr__(self, name):
+        return getattr(getattr(current_pool.get(), self._attr), name)
+
+members_cache = TenantLocal("members")
+
+async def reload_caches(pool: DBPool):
+    """Перечитывает кэши из БД (старт и подмена файла базы)."""
+    pool.members.invalidate()
+    pool.calendar.clear()
+    async with pool.read() as db:
+        await pool.members.load(db)
 
 # ---------- ХЕЛПЕРЫ ----------
+MEMBER_COLS = "id, name, remaining, trainings_total, vacation"
+
 async def get_all_members(db):
-    async with db.execute(
-        "SELECT id, name, remaining, trainings_total, vacation FROM members ORDER BY name"
-    ) as c:
-        return await c.fetchall()
+    if members_cache.loaded:
+        members_cache.stats["hit"] += 1
+        return members_cache.all()
+    members_cache.stats["miss"] += 1
+    await members_cache.load(db)
+    return members_cache.all()
 
 async def get_member_by_id(db, member_id: int):
+    row = members_cache.by_id.get(member_id)
+    if row is not None:
+        members_cache.stats["hit"] += 1
+        return row
+    members_cache.stats["miss"] += 1
     async with db.execute(
         "SELECT id, name, remaining, trainings_total, vacation FROM members WHERE id=?", (member_id,)
     ) as c:
-        return await c.fetchone()
+        row = await c.fetchone()
+    if row and members_cache.loaded:
+        members_cache.put(row)
+    return row
+
+async def find_member(pool: DBPool, name: str):
+    """Точное имя, иначе нечёткий поиск по кэшу.
+
+    Возвращает (строка, []) при совпадении нормализованного ключа (регистр,
+    ё/е, транслит) или (None, кандидаты). Опечатку сразу не применяем:
+    «Миша» похож на «Машу» не меньше, чем на Мишу, а /renew и /edit меняют
+    данные — выбирает человек кнопкой.
+    """
+    async with pool.read() as db:
+        row = await get_member_by_name(db, name)
+        if row:
+            return row, []
+        await get_all_members(db)
+    scored = members_cache.fuzzy(name)
+    exact = [row for score, row in scored if score == 1]
+    if len(exact) == 1:
+        return exact[0], []
+    return None, [row for _score, row in scored]
+
+async def get_member_by_name(db, name: str):
+    member_id = members_cache.by_name.get(name)
+    if member_id is not None:
+        members_cache.stats["hit"] += 1
+        return members_cache.by_id[member_id]
+    members_cache.stats["miss"] += 1
+    async with db.execute(
+        "SELECT id, name, remaining, trainings_total, vacation FROM members WHERE name=?", (name,)
+    ) as c:
+        row = await c.fetchone()
+    if row and members_cache.loaded:
+        members_cache.put(row)
+    return row
+
+async def add_member(db, name: str, trainings: int):
+    """INSERT нового ученика; IntegrityError, если имя занято."""
+    c = await db.execute(
+        "INSERT INTO members(name, trainings_total, remaining) VALUES(?,?,?)",
+        (name, trainings, trainings),
+    )
+    if members_cache.loaded:
+        members_cache.put((c.lastrowid, name, trainings, trainings, 0))
+    return c.lastrowid
+
+async def toggle_vacation(db, member_id: int):
+    # переключение в SQL: два быстрых нажатия дают вкл/выкл, а не одно и то же значение
+    async with db.execute(
+        "UPDATE members SET vacation = 1 - vacation WHERE id=? RETURNING " + MEMBER_COLS, (member_id,)
+    ) as c:
+        row = await c.fetchone()
+    if row:
+        members_cache.put(row)
+    return row
+
+# Списание/пропуск считаются прямо в SQL — никакого read-modify-write в Python
+CHANGE_VISIT_UPDATE = """
+UPDATE members SET
+  remaining = CASE WHEN :came AND NOT vacation THEN MAX(remaining - 1, 0) ELSE remaining END,
+  last_visit_at = CASE WHEN :came AND NOT vacation THEN :now ELSE last_visit_at END
+WHERE id = :id
+"""
+CHANGE_VISIT_SQL = CHANGE_VISIT_UPDATE + "RETURNING " + MEMBER_COLS
 
 async def change_visit(db, member_id: int, came: bool):
-    now = dt.datetime.utcnow().isoformat()
-    row = await get_member_by_id(db, member_id)
+    """Отмечает посещение/пропуск; возвращает новую строку ученика или None."""
+    now = int(time.time())
+    async with db.execute(CHANGE_VISIT_SQL, {"came": came, "now": now, "id": member_id}) as c:
+        row = await c.fetchone()
     if not row:
         return None
-    _id, _name, remaining, total, vacation = row
-
     status = "came" if came else "missed"
-    await db.execute("INSERT INTO visits(member_id, dt, status) VALUES(?,?,?)", (member_id, now, status))
+    charged = came and not row[4]
+    await db.execute(
+        "INSERT INTO visits(member_id, dt, status, charged) VALUES(?,?,?,?)", (member_id, now, status, int(charged))
+    )
+    await bump_daily(db, [(member_id, now, int(came), int(not came), int(charged), 0)])
+    calendar_cache.bump()
+    members_cache.put(row)
+    return row
 
-    if came and not vacation:
-        new_remaining = max(remaining - 1, 0)
-        await db.execute(
-            "UPDATE members SET remaining=?, last_visit_at=? WHERE id=?",
-            (new_remaining, now, member_id),
-        )
+BUMP_DAILY_SQL = """
+INSERT INTO daily_stats(member_id, day, came, missed, charged, renewed) VALUES(?, ?, ?, ?, ?, ?)
+ON CONFLICT(member_id, day) DO UPDATE SET
+  came = came + excluded.came,
+  missed = missed + excluded.missed,
+  charged = MAX(charged + excluded.charged, 0),
+  renewed = renewed + excluded.renewed
+"""
 
-    await db.commit()
-    return True
+async def bump_daily(db, deltas):
+    """Сдвигает суточные сводки: deltas — [(member_id, ts, came, missed, charged, renewed)]."""
+    await db.executemany(BUMP_DAILY_SQL, [(d[0], d[1] // 86400) + tuple(d[2:]) for d in deltas])
+
+async def mark_came_many(db, member_ids):
+    """Отмечает приход сразу нескольким ученикам (executemany); возвращает их новые строки."""
+    now = int(time.time())
+    await db.executemany(CHANGE_VISIT_UPDATE,
+                         [{"came": True, "now": now, "id": member_id} for member_id in member_ids])
+    marks = ",".join("?" * len(member_ids))
+    async with db.execute(
+        f"SELECT {MEMBER_COLS} FROM members WHERE id IN ({marks}) ORDER BY name", list(member_ids)
+    ) as c:
+        rows = await c.fetchall()
+    await db.executemany("INSERT INTO visits(member_id, dt, status, charged) VALUES(?, ?, 'came', ?)",
+                         [(row[0], now, int(not row[4])) for row in rows])
+    await bump_daily(db, [(row[0], now, 1, 0, int(not row[4]), 0) for row in rows])
+    calendar_cache.bump()
+    for row in rows:
+        members_cache.put(row)
+    return rows
 
 async def undo_last(db, member_id: int):
+    """Удаляет последнюю отметку; возвращает (новая строка ученика, ошибка)."""
     async with db.execute(
-        "SELECT id, status FROM visits WHERE member_id=? ORDER BY id DESC LIMIT 1", (member_id,)
+        "DELETE FROM visits WHERE id = "
+        "(SELECT id FROM visits WHERE member_id=? ORDER BY id DESC LIMIT 1) RETURNING status, dt, charged",
+        (member_id,),
     ) as c:
         last = await c.fetchone()
     if not last:
         return None, "Нет записей для отмены."
-    visit_id, status = last
-
-    _id, name, remaining, total, vacation = await get_member_by_id(db, member_id)
+    status, ts, charged = last
+    came = status == "came"
+    await bump_daily(db, [(member_id, ts, -came, -(not came), -charged, 0)])
+    calendar_cache.bump()
 
-    if status == "came":
-        new_remaining = min(remaining + 1, total)
-        await db.execute("UPDATE members SET remaining=? WHERE id=?", (new_remaining, member_id))
-
-    await db.execute("DELETE FROM visits WHERE id=?", (visit_id,))
-    await db.commit()
-    return name, None
+    # отметка в отпуске ничего не списала — и возвращать нечего
+    if charged:
+        async with db.execute(
+            "UPDATE members SET remaining = MIN(remaining + 1, trainings_total) "
+            "WHERE id=? RETURNING " + MEMBER_COLS,
+            (member_id,),
+        ) as c:
+            row = await c.fetchone()
+        members_cache.put(row)
+    else:
+        row = await get_member_by_id(db, member_id)
+    return row, None
 
-async def renew_trainings(db, member_id: int, new_total=None):
-    row = await get_member_by_id(db, member_id)
+async def renew_trainings(db, member_id: int, new_total=None, count_renewal: bool = True):
+    """Новый пакет; count_renewal=False — правка пакета (/edit), не покупка."""
+    async with db.execute(
+        "UPDATE members SET trainings_total = COALESCE(:n, trainings_total), "
+        "remaining = COALESCE(:n, trainings_total) WHERE id = :id RETURNING " + MEMBER_COLS,
+        {"n": new_total, "id": member_id},
+    ) as c:
+        row = await c.fetchone()
     if not row:
         return None
-    _id, _name, _rem, total, _vac = row
-    trainings = new_total if new_total is not None else total
+    if count_renewal:
+        await bump_daily(db, [(member_id, int(time.time()), 0, 0, 0, 1)])
+    members_cache.put(row)
+    return row[3]
+
+async def get_meta(db, key: str, default=None):
+    async with db.execute("SELECT value FROM meta WHERE key=?", (key,)) as c:
+        row = await c.fetchone()
+    return row[0] if row else default
+
+def read_meta_file(path: str, keys) -> dict:
+    """Значения meta прямо из файла — без пула, миграций и кэшей (для планировщиков).
+
+    Нет файла или таблицы — пустой словарь.
+    """
+    marks = ",".join("?" * len(keys))
+    try:
+        with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as db:
+            return dict(db.execute(f"SELECT key, value FROM meta WHERE key IN ({marks})", tuple(keys)).fetchall())
+    except sqlite3.Error:
+        return {}
+
+async def set_meta(db, key: str, value):
     await db.execute(
-        "UPDATE members SET trainings_total=?, remaining=? WHERE id=?",
-        (trainings, trainings, member_id),
+        "INSERT INTO meta(key, value) VALUES(?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        (key, value),
     )
-    await db.commit()
-    return trainings
+
+def day_start(day: dt.date) -> int:
+    """Начало суток (UTC) в секундах epoch — в этих единицах хранится visits.dt."""
+    return int(dt.datetime(day.year, day.month, day.day, tzinfo=dt.timezone.utc).timestamp())
+
+# ---------- ЭКСПОРТ ----------
+EXPORT_HEADER = ["member_id", "member_name", "dt", "status", "remaining", "trainings_total", "vacation"]
+
+# Сколько держать выгрузку в памяти, прежде чем SpooledTemporaryFile уйдёт на диск
+EXPORT_SPOOL_BYTES = 4 * 1024 * 1024
+
+class SpooledInputFile(InputFile):
+    """Отдаёт в Telegram уже открытый файл кусками, не копируя его в память целиком."""
+
+    def __init__(self, file, filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot):
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size):
+            yield chunk
+
+async def export_visits(db, out, since=None, until=None, member_id=None, after_id=0):
+    """Пишет журнал в `out` как CSV.gz построчно из курсора.
+
+    since/until — секунды epoch (until не включительно), after_id — водяной знак visits.id.
+    Без водяного знака сначала идут архивные месяцы из visits_archive.
+    Возвращает (число строк, последний visits.id).
+    """
+    where, params = ["v.id > ?"], [after_id]
+    if since is not None:
+        where.append("v.dt >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("v.dt < ?")
+        params.append(until)
+    if member_id is not None:
+        where.append("v.member_id = ?")
+        params.append(member_id)
+    count, last_id = 0, after_id
+    with io.TextIOWrapper(gzip.GzipFile(fileobj=out, mode="wb"), encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(EXPORT_HEADER)
+        if not after_id:
+            # архивные месяцы: по строке на отметку, время — начало месяца
+            arch = [cond.replace("v.dt", "a.month").replace("v.member_id", "a.member_id")
+                    for cond in where[1:]]
+            async with db.execute(f"""
+                SELECT a.member_id, m.name, strftime('%Y-%m-%dT%H:%M:%S', a.month, 'unixepoch'),
+                       a.came, a.missed, m.remaining, m.trainings_total, m.vacation
+                FROM visits_archive a
+                LEFT JOIN members m ON m.id = a.member_id
+                WHERE {" AND ".join(arch) or "1"}
+                ORDER BY a.month, a.member_id
+            """, params[1:]) as c:
+                async for member_id, name, month, came, missed, rem, total, vac in c:
+                    for status, n in (("came", came), ("missed", missed)):
+                        for _ in range(n):
+                            w.writerow((member_id, name, month, status, rem, total, vac))
+                        count += n
+        async with db.execute(f"""
+            SELECT v.id, v.member_id, m.name, strftime('%Y-%m-%dT%H:%M:%S', v.dt, 'unixepoch'),
+                   v.status, m.remaining, m.trainings_total, m.vacation
+            FROM visits v
+            LEFT JOIN members m ON m.id = v.member_id
+            WHERE {" AND ".join(where)}
+            ORDER BY v.id
+        """, params) as c:
+            async for row in c:
+                w.writerow(row[1:])
+                count, last_id = count + 1, row[0]
+    return count, last_id
+
+def parse_export_args(args):
+    """'/export [с] [по] [Имя|new]' -> (since, until, name, incremental) или ValueError."""
+    dates, name, incremental = [], None, False
+    for arg in args:
+        if arg.lower() in ("new", "новые"):
+            incremental = True
+        elif arg[:1].isdigit():
+            dates.append(dt.date.fromisoformat(arg))
+        else:
+            name = arg
+    if len(dates) > 2:
+        raise ValueError("слишком много дат")
+    since = day_start(dates[0]) if dates else None
+    until = day_start(dates[1] + dt.timedelta(days=1)) if len(dates) == 2 else None
+    return since, until, name, incremental
+
+# ---------- ИМПОРТ ----------
+# Вариант «только ученики»; журнал принимается в раскладке EXPORT_HEADER
+IMPORT_MEMBERS_HEADER = ["name", "trainings_total", "remaining", "vacation"]
+IMPORT_EXTS = (".csv", ".csv.gz")
+# Строк на один проход executemany и сколько отклонённых строк показывать
+IMPORT_CHUNK = 5000
+IMPORT_REJECTS_SHOWN = 20
+
+MEMBER_UPSERT_SQL = """
+INSERT INTO members(name, trainings_total, remaining, vacation) VALUES(?, ?, ?, ?)
+ON CONFLICT(name) DO UPDATE SET
+  trainings_total = excluded.trainings_total,
+  remaining = excluded.remaining,
+  vacation = excluded.vacation
+"""
+
+# Журнал везёт баланс на момент выгрузки: живых учеников он не перезаписывает
+MEMBER_INSERT_SQL = """
+INSERT INTO members(name, trainings_total, remaining, vacation) VALUES(?, ?, ?, ?)
+ON CONFLICT(name) DO NOTHING
+"""
+
+def _import_int(value: str, default: int, what: str) -> int:
+    value = value.strip()
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{what}: «{value[:20]}» — не число") from None
+
+def _import_member(name: str, total: str, rem: str, vac: str):
+    name = name.strip()
+    if not name:
+        raise ValueError("пустое имя")
+    total = _import_int(total, 12, "trainings_total")
+    rem = _import_int(rem, total, "remaining")
+    vac = _import_int(vac, 0, "vacation")
+    if total < 0 or rem < 0 or vac not in (0, 1):
+        raise ValueError("недопустимые числа")
+    return name, total, rem, vac
+
+def _import_ts(value: str) -> int:
+    try:
+        t = dt.datetime.fromisoformat(value.strip())
+    except ValueError:
+        raise ValueError(f"dt: «{value[:25]}» — не дата") from None
+    if t.tzinfo is None:
+        # экспорт пишет время в UTC без зоны
+        t = t.replace(tzinfo=dt.timezone.utc)
+    return int(t.timestamp())
+
+async def _member_ids(db, names):
+    ids = {}
+    names = list(names)
+    for i in range(0, len(names), 900):
+        part = names[i:i + 900]
+        async with db.execute(
+            f"SELECT name, id FROM members WHERE name IN ({','.join('?' * len(part))})", part
+        ) as c:
+            ids.update(await c.fetchall())
+    return ids
+
+async def import_csv(db, reader, header):
+    """Загружает CSV в текущей транзакции кусками по IMPORT_CHUNK строк.
+
+    header — первая строка файла: раскладка экспорта (журнал) или
+    IMPORT_MEMBERS_HEADER. Список учеников обновляет их по имени; журнал
+    только добавляет новых — баланс из старой выгрузки не откатывает живой.
+    Отметки загружаются только для учеников, которых до импорта не было,
+    поэтому повторный импорт того же файла не дублирует журнал.
+    Возвращает (Counter итогов, [(номер строки, причина)]).
+    """
+    col = {h: i for i, h in enumerate(header)}
+    visits_kind = "status" in col
+    name_col = "member_name" if visits_kind else "name"
+    get = lambda row, key: row[col[key]] if key in col and col[key] < len(row) else ""
+    stats, rejects = Counter(), []
+    known = {}  # имя -> (id, новый ли)
+
+    def reject(line: int, reason: str):
+        stats["rejected"] += 1
+        if len(rejects) < IMPORT_REJECTS_SHOWN:
+            rejects.append((line, reason))
+
+    async def flush(members, visits):
+        fresh = [n for n in members if n not in known]
+        existed = await _member_ids(db, fresh)
+        # журнал несёт состояние ученика на момент выгрузки — достаточно первого вхождения
+        rows = members.values() if not visits_kind else [members[n] for n in fresh]
+        await db.executemany(MEMBER_INSERT_SQL if visits_kind else MEMBER_UPSERT_SQL, rows)
+        kept = "members_kept" if visits_kind else "members_updated"
+        for name, member_id in (await _member_ids(db, fresh)).items():
+            known[name] = (member_id, name not in existed)
+            stats[kept if name in existed else "members_added"] += 1
+        if not visits_kind:
+            stats["members_updated"] += len(rows) - len(fresh)
+            return
+        new_visits, daily, last = [], {}, {}
+        for name, ts, status in visits:
+            member_id, is_new = known[name]
+            if not is_new:
+                stats["visits_skipped"] += 1
+                continue
+            new_visits.append((member_id, ts, status, int(status == "came")))
+            d = daily.setdefault((member_id, ts // 86400), [0, 0])
+            d[status == "missed"] += 1
+            if status == "came":
+                last[member_id] = max(last.get(member_id, 0), ts)
+        await db.executemany("INSERT INTO visits(member_id, dt, status, charged) VALUES(?, ?, ?, ?)", new_visits)
+        await bump_daily(db, [(mid, day * 86400, came, missed, came, 0)
+                              for (mid, day), (came, missed) in daily.items()])
+        await db.executemany(
+            "UPDATE members SET last_visit_at = MAX(COALESCE(last_visit_at, 0), ?) WHERE id = ?",
+            [(ts, mid) for mid, ts in last.items()],
+        )
+        stats["visits"] += len(new_visits)
+
+    members, visits = {}, []
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            break
+        except csv.Error as e:
+            reject(reader.line_num, f"CSV: {e}")
+            continue
+        if not any(cell.strip() for cell in row):
+            continue
+        try:
+            member = _import_member(get(row, name_col), get(row, "trainings_total"),
+                                    get(row, "remaining"), get(row, "vacation"))
+            if visits_kind:
+                status = get(row, "status").strip()
+                if status not in ("came", "missed"):
+                    raise ValueError(f"статус «{status}»")
+                visits.append((member[0], _import_ts(get(row, "dt")), status))
+                members.setdefault(member[0], member)
+            else:
+                members[member[0]] = member
+        except ValueError as e:
+            reject(reader.line_num, str(e))
+            continue
+        if len(visits) + len(members) >= IMPORT_CHUNK:
+            await flush(members, visits)
+            members, visits = {}, []
+    if members or visits:
+        await flush(members, visits)
+    return stats, rejects
+
+# ---------- БЭКАПЫ ----------
+def human_size(n: int) -> str:
+    for unit in ("Б", "КБ", "МБ"):
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} ГБ"
+
+def _gzip_file(src: str, dst: str):
+    with open(src, "rb") as f_in, gzip.open(dst, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+
+def _gunzip_file(src: str, dst: str):
+    with gzip.open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+
+def check_db_file(path: str) -> int:
+    """Проверяет присланную базу; возвращает её версию схемы или бросает ValueError."""
+    # immutable: только чтение, без -wal/-shm рядом с временным файлом
+    con = sqlite3.connect(f"file:{path}?immutable=1", uri=True)
+    try:
+        (result,) = con.execute("PRAGMA integrity_check").fetchone()
+        if result != "ok":
+            raise ValueError(f"integrity_check: {result}")
+        (version,) = con.execute("PRAGMA user_version").fetchone()
+        if version > SCHEMA_VERSION:
+            raise ValueError(f"схема v{version} новее, чем поддерживает бот (v{SCHEMA_VERSION})")
+        tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        missing = {"members", "visits"} - tables
+        if missing:
+            raise ValueError(f"нет таблиц: {', '.join(sorted(missing))}")
+        return version
+    finally:
+        con.close()
+
+def backup_paths(stem: str = "gym"):
+    """Архивы базы `stem` в BACKUP_DIR, от старых к новым (метка времени в имени)."""
+    return sorted(glob.glob(os.path.join(BACKUP_DIR, f"{stem}_backup_*.db.gz")))
+
+def prune_backups(keep: int = BACKUP_KEEP, stem: str = "gym"):
+    """Оставляет `keep` последних архивов базы `stem` в BACKUP_DIR."""
+    paths = backup_paths(stem)
+    for path in paths[:-keep] if keep > 0 else []:
+        os.remove(path)
+
+def last_backup_at(stem: str) -> float:
+    """mtime свежего архива базы `stem`; 0 — архивов нет."""
+    paths = backup_paths(stem)
+    return os.path.getmtime(paths[-1]) if paths else 0.0
+
+async def make_backup(pool: DBPool):
+    """Консистентная копия живой БД через online backup API, сжатая gzip.
+
+    Возвращает (путь к .db.gz, размер в байтах, длительность в секундах).
+    """
+    started = time.monotonic()
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    ts = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+    # gym для общей базы, id чата для баз арендаторов
+    stem = os.path.splitext(os.path.basename(pool.path))[0]
+    raw_path = os.path.join(BACKUP_DIR, f".{stem}_backup_{ts}.db.tmp")
+    gz_path = os.path.join(BACKUP_DIR, f"{stem}_backup_{ts}.db.gz")
+    try:
+        async with aiosqlite.connect(raw_path) as target, pool.read() as db:
+            # копируем с читателя: в WAL он не мешает писателю
+            await db.backup(target, pages=BACKUP_PAGES_PER_STEP)
+        await asyncio.to_thread(_gzip_file, raw_path, gz_path)
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+    await asyncio.to_thread(prune_backups, BACKUP_KEEP, stem)
+    return gz_path, os.path.getsize(gz_path), time.monotonic() - started
+
+async def backup_scheduler(tenants: TenantPools, interval_h: float = BACKUP_INTERVAL_H,
+                           check_s: float = 600):
+    interval = interval_h * 3600
+    while True:
+        for key in tenants.known():
+            # срок считаем от свежего архива на диске, а не от старта процесса:
+            # при частых перезапусках бэкап иначе не наступал бы никогда
+            stem = os.path.splitext(os.path.basename(tenants.path(key)))[0]
+            if time.time() - await asyncio.to_thread(last_backup_at, stem) < interval:
+                continue
+            try:
+                async with tenants.use(key) as pool:
+                    path, size, took = await make_backup(pool)
+                log.info("backup %s: %s in %.2fs", path, human_size(size), took)
+            except Exception:
+                log.exception("scheduled backup of tenant %s failed", key)
+        await asyncio.sleep(min(check_s, interval))
+
+# ---------- СТАТИСТИКА ----------
+def _rate(missed: int, came: int) -> str:
+    total = came + missed
+    return f"{missed * 100 / total:.0f}%" if total else "—"
+
+def _streaks(days):
+    """(текущая, лучшая) серия дней с приходом без пропусков; days — [(day, came, missed)]."""
+    best = run = 0
+    for _day, came, missed in days:
+        if missed:
+            run = 0
+        elif came:
+            run += 1
+            best = max(best, run)
+    return run, best
+
+async def gym_stats(db, today: int) -> str:
+    lines = ["📊 Статистика зала"]
+    for title, since in (("7 дней", today - 6), ("30 дней", today - 29), ("всё время", 0)):
+        async with db.execute(
+            "SELECT COALESCE(SUM(came), 0), COALESCE(SUM(missed), 0), COALESCE(SUM(charged), 0), "
+            "COALESCE(SUM(renewed), 0), COUNT(DISTINCT member_id) FROM daily_stats WHERE day >= ?",
+            (since,),
+        ) as c:
+            came, missed, charged, renewed, active = await c.fetchone()
+        lines.append(
+            f"• {title}: приходов {came}, пропусков {missed} ({_rate(missed, came)}), "
+            f"списано {charged}, продлений {renewed}, активных {active}"
+        )
+    async with db.execute(
+        "SELECT strftime('%Y-%m', day * 86400, 'unixepoch') AS month, SUM(came), SUM(missed) "
+        "FROM daily_stats WHERE day >= ? GROUP BY month ORDER BY month",
+        (today - 185,),
+    ) as c:
+        months = await c.fetchall()
+    if months:
+        lines.append("\nПо месяцам (приходы / пропуски):")
+        lines += [f"{month}: {came} / {missed}" for month, came, missed in months]
+    return "\n".join(lines)
+
+async def member_stats(db, row, today: int) -> str:
+    member_id, name, rem, total, vac = row
+    async with db.execute(
+        "SELECT day, came, missed, charged, renewed FROM daily_stats WHERE member_id=? ORDER BY day",
+        (member_id,),
+    ) as c:
+        days = await c.fetchall()
+    lines = [f"📊 {name}: осталось {rem}/{total}" + (" 🏖" if vac else "")]
+    for title, since in (("7 дней", today - 6), ("30 дней", today - 29), ("всё время", 0)):
+        came = sum(d[1] for d in days if d[0] >= since)
+        missed = sum(d[2] for d in days if d[0] >= since)
+        lines.append(f"• {title}: приходов {came}, пропусков {missed} ({_rate(missed, came)})")
+    weeks = max((today - days[0][0]) / 7, 1) if days else 1
+    current, best = _streaks([(d[0], d[1], d[2]) for d in days])
+    lines.append(f"• в среднем {sum(d[1] for d in days) / weeks:.1f} приходов в неделю")
+    lines.append(f"• серия без пропусков: {current} (лучшая {best})")
+    lines.append(f"• списано тренировок: {sum(d[3] for d in days)}, продлений пакета: {sum(d[4] for d in days)}")
+    return "\n".join(lines)
+
+# ---------- АРХИВ ----------
+ARCHIVE_SQL = """
+INSERT INTO visits_archive(member_id, month, came, missed)
+  SELECT member_id, CAST(strftime('%s', dt, 'unixepoch', 'start of month') AS INTEGER),
+         SUM(status = 'came'), SUM(status = 'missed')
+  FROM visits WHERE dt < ?
+  GROUP BY 1, 2
+ON CONFLICT(member_id, month) DO UPDATE SET
+  came = came + excluded.came,
+  missed = missed + excluded.missed
+"""
+
+async def archive_visits(db, cutoff: int) -> int:
+    """Сворачивает отметки старше cutoff (секунды epoch) в visits_archive; возвращает их число."""
+    await db.execute(ARCHIVE_SQL, (cutoff,))
+    c = await db.execute("DELETE FROM visits WHERE dt < ?", (cutoff,))
+    return c.rowcount
+
+async def compact_db(pool: DBPool) -> int:
+    """Возвращает ОС свободные страницы; один раз переводит старую базу на auto_vacuum."""
+    async with pool.write() as db:
+        async with db.execute("PRAGMA auto_vacuum") as c:
+            (mode,) = await c.fetchone()
+        async with db.execute("PRAGMA freelist_count") as c:
+            (free,) = await c.fetchone()
+        if mode != 2:
+            await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await db.execute("VACUUM")
+        else:
+            await db.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+        # в WAL файл базы укорачивается только при checkpoint
+        await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return free
+
+async def run_archive(pool: DBPool, days: int = ARCHIVE_AFTER_DAYS):
+    """Архивация + уплотнение; возвращает (перенесено отметок, освобождено страниц)."""
+    moved = 0
+    if days > 0:
+        cutoff = day_start(dt.date.today() - dt.timedelta(days=days))
+        moved = await pool.submit(lambda db: archive_visits(db, cutoff))
+        if moved:
+            pool.calendar.bump()
+    freed = await compact_db(pool)
+    await pool.submit(lambda db: set_meta(db, "archive_at", int(time.time())))
+    return moved, freed
+
+async def archive_scheduler(tenants: TenantPools, interval_h: float = ARCHIVE_INTERVAL_H,
+                            check_s: float = 600):
+    interval = interval_h * 3600
+    while True:
+        for key in tenants.known():
+            # время прошлого прогона — в meta базы: переживает перезапуски
+            meta = await asyncio.to_thread(read_meta_file, tenants.path(key), ("archive_at",))
+            if time.time() - int(meta.get("archive_at") or 0) < interval:
+                continue
+            try:
+                async with tenants.use(key) as pool:
+                    moved, freed = await run_archive(pool)
+                log.info("archive %s: moved %d visits, freed %d pages", key, moved, freed)
+            except Exception:
+                log.exception("scheduled archive of tenant %s failed", key)
+        await asyncio.sleep(min(check_s, interval))
+
+# ---------- НАПОМИНАНИЯ ----------
+class SendQueue:
+    """Очередь исходящих сообщений фоновых задач.
+
+    Token bucket держит темп в пределах лимитов Telegram, TelegramRetryAfter
+    откладывает отправку на указанное время. Интерактивные хендлеры отвечают
+    напрямую и в этой очереди не стоят.
+    """
+
+    def __init__(self, rate: float = SEND_RATE, burst: int = SEND_BURST, retries: int = SEND_RETRIES):
+        self.rate = max(rate, 0.1)
+        self.burst = max(burst, 1)
+        self.retries = retries
+        self.stats = Counter()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def put(self, chat_id: int, text: str):
+        # длинный дайджест режем по строкам под лимит сообщения
+        chunk = ""
+        for line in text.split("\n"):
+            if chunk and len(chunk) + len(line) + 1 > 4096:
+                self._queue.put_nowait((chat_id, chunk))
+                chunk = ""
+            chunk = f"{chunk}\n{line}" if chunk else line[:4096]
+        if chunk:
+            self._queue.put_nowait((chat_id, chunk))
+
+    async def _take(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def run(self, bot: Bot):
+        while True:
+            chat_id, text = await self._queue.get()
+            for attempt in range(self.retries + 1):
+                await self._take()
+                try:
+                    await bot.send_message(chat_id, text)
+                    self.stats["sent"] += 1
+                    break
+                except TelegramRetryAfter as e:
+                    self.stats["retry_after"] += 1
+                    log.warning("send to %s: retry after %ss", chat_id, e.retry_after)
+                    await asyncio.sleep(e.retry_after)
+                except TelegramForbiddenError:
+                    self.stats["forbidden"] += 1
+                    log.warning("send to %s: bot is blocked", chat_id)
+                    break
+                except TelegramAPIError:
+                    self.stats["failed"] += 1
+                    log.exception("send to %s failed", chat_id)
+                    break
+            else:
+                self.stats["failed"] += 1
+
+send_queue = SendQueue()
+
+async def reminder_digest(db, today: int, low_left: int = REMIND_LOW_LEFT,
+                          idle_days: int = REMIND_IDLE_DAYS, limit: int = 50) -> str:
+    """Текст напоминания (пустой, если напоминать не о ком); запросы идут по частичным индексам."""
+    async with db.execute(
+        "SELECT name, remaining, trainings_total FROM members "
+        "WHERE vacation = 0 AND remaining <= ? ORDER BY remaining, name",
+        (low_left,),
+    ) as c:
+        low = await c.fetchall()
+    async with db.execute(
+        "SELECT name, last_visit_at FROM members "
+        "WHERE vacation = 0 AND last_visit_at < ? ORDER BY last_visit_at",
+        ((today - idle_days) * 86400,),
+    ) as c:
+        idle = await c.fetchall()
+    parts = []
+    if low:
+        lines = [f"• {name} — {rem}/{total}" for name, rem, total in low[:limit]]
+        if len(low) > limit:
+            lines.append(f"… и ещё {len(low) - limit}")
+        parts.append("Заканчиваются тренировки:\n" + "\n".join(lines))
+    if idle:
+        lines = [f"• {name} — {today - last // 86400} дн." for name, last in idle[:limit]]
+        if len(idle) > limit:
+            lines.append(f"… и ещё {len(idle) - limit}")
+        parts.append(f"Не приходили {idle_days}+ дн.:\n" + "\n".join(lines))
+    return "🔔 Напоминание\n\n" + "\n\n".join(parts) if parts else ""
+
+# Путь базы -> (remind_chat, remind_day): планировщик по нему решает, открывать
+# ли базу. Пишут send_reminders, /remind и /restore; чего нет — читается из файла.
+remind_state = {}
+
+def _read_remind_state(path: str):
+    """(remind_chat, remind_day) из meta файла базы."""
+    meta = read_meta_file(path, ("remind_chat", "remind_day"))
+    return int(meta.get("remind_chat") or 0), int(meta.get("remind_day") or 0)
+
+async def send_reminders(pool: DBPool, queue: SendQueue, today: int, force: bool = False) -> bool:
+    """Ставит дайджест в очередь подписанному чату; не чаще раза в сутки, если не force."""
+    async with pool.read() as db:
+        chat_id = int(await get_meta(db, "remind_chat") or 0)
+        last_day = int(await get_meta(db, "remind_day", 0))
+        remind_state[pool.path] = (chat_id, last_day)
+        if not chat_id or (last_day >= today and not force):
+            return False
+        text = await reminder_digest(db, today)
+    await pool.submit(lambda db: set_meta(db, "remind_day", today))
+    remind_state[pool.path] = (chat_id, today)
+    if text:
+        queue.put(chat_id, text)
+    return bool(text)
+
+async def reminder_scheduler(tenants: TenantPools, queue: SendQueue, check_s: float = 600):
+    while True:
+        now = time.time()
+        if dt.datetime.fromtimestamp(now, dt.timezone.utc).hour >= REMIND_HOUR:
+            today = int(now) // 86400
+            for key in tenants.known():
+                path = tenants.path(key)
+                if path not in remind_state:
+                    remind_state[path] = await asyncio.to_thread(_read_remind_state, path)
+                chat_id, last_day = remind_state[path]
+                # без подписки или уже разосланное сегодня — базу не открываем
+                if not chat_id or last_day >= today:
+                    continue
+                try:
+                    async with tenants.use(key) as pool:
+                        await send_reminders(pool, queue, today)
+                except Exception:
+                    log.exception("reminders for tenant %s failed", key)
+        await asyncio.sleep(check_s)
+
+# ---------- CALLBACK-ДАННЫЕ ----------
+class Act(str, Enum):
+    """Действия подменю ученика; значение — код в callback_data."""
+    came = "c"
+    missed = "m"
+    renew = "r"
+    edit = "e"
+    undo = "u"
+    vacation = "v"
+
+class MemberCb(CallbackData, prefix="m"):
+    """Открыть ученика: «m:<id>»."""
+    id: int
+
+class ActionCb(CallbackData, prefix="a"):
+    """Действие над учеником: «a:<код Act>:<id>»."""
+    act: Act
+    id: int
+
+class PickCb(CallbackData, prefix="p"):
+    """Выбор из кандидатов нечёткого поиска: «p:<id>:<код Act>:<число>».
+
+    Несёт отложенную команду (/renew, /edit) с её числом; без act — просто
+    открыть ученика.
+    """
+    id: int
+    act: Optional[Act] = None
+    n: Optional[int] = None
 
 # ---------- КЛАВИАТУРЫ ----------
-def members_keyboard(members):
-    rows = [[InlineKeyboardButton(text=name, callback_data=f"member_{member_id}")]
+def members_keyboard(members, page: int = 0, letter: str = None, page_size: int = ROSTER_PAGE_SIZE):
+    pages = max((len(members) + page_size - 1) // page_size, 1)
+    page = min(max(page, 0), pages - 1)
+    chunk = members[page * page_size:(page + 1) * page_size]
+    rows = [[InlineKeyboardButton(text=name, callback_data=MemberCb(id=member_id).pack())]
+            for member_id, name, rem, total, vac in chunk]
+    if pages > 1:
+        prefix = f"letter_{letter}_" if letter else "page_"
+        rows.append([
+            InlineKeyboardButton(text="◀️", callback_data=f"{prefix}{(page - 1) % pages}"),
+            InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="noop"),
+            InlineKeyboardButton(text="▶️", callback_data=f"{prefix}{(page + 1) % pages}"),
+        ])
+    if letter:
+        rows.append([InlineKeyboardButton(text="⬅️ Назад ко всем", callback_data="back_to_list")])
+    elif pages > 1:
+        rows.append([InlineKeyboardButton(text="🔤 По буквам", callback_data="letters")])
+    if not letter:
+        rows.append([InlineKeyboardButton(text="👥 Отметить группу", callback_data="batch_start")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def batch_keyboard(members, selected, page: int = 0, page_size: int = ROSTER_PAGE_SIZE):
+    """Список с галочками для групповой отметки; выбор живёт в FSM, не в БД."""
+    pages = max((len(members) + page_size - 1) // page_size, 1)
+    page = min(max(page, 0), pages - 1)
+    chunk = members[page * page_size:(page + 1) * page_size]
+    rows = [[InlineKeyboardButton(text=("✅ " if member_id in selected else "▫️ ") + name,
+                                  callback_data=f"bt_{member_id}_{page}")]
+            for member_id, name, rem, total, vac in chunk]
+    if pages > 1:
+        rows.append([
+            InlineKeyboardButton(text="◀️", callback_data=f"bp_{(page - 1) % pages}"),
+            InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="noop"),
+            InlineKeyboardButton(text="▶️", callback_data=f"bp_{(page + 1) % pages}"),
+        ])
+    rows.append([
+        InlineKeyboardButton(text=f"💾 Отметить ({len(selected)})", callback_data="batch_ok"),
+        InlineKeyboardButton(text="✖️ Отмена", callback_data="batch_cancel"),
+    ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def candidates_keyboard(members, act: Act = None, n: int = None):
+    rows = [[InlineKeyboardButton(text=f"{name} — {rem}/{total}",
+                                  callback_data=PickCb(id=member_id, act=act, n=n).pack())]
             for member_id, name, rem, total, vac in members]
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+def letters_keyboard(letters, per_row: int = 6):
+    rows = [[InlineKeyboardButton(text=ch, callback_data=f"letter_{ch}_0") for ch in letters[i:i + per_row]]
+            for i in range(0, len(letters), per_row)]
+    rows.append([InlineKeyboardButton(text="⬅️ Назад ко всем", callback_data="back_to_list")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def members_list_text(members) -> str:
+    def line(name, rem, total, vac):
+        tail = " 🏖" if vac else ""
+        return f"{name} — {rem}/{total}{tail}"
+    lines = [line(name, rem, total, vac) for _id, name, rem, total, vac in members]
+    return "Список учеников:\n" + "\n".join(lines)
+
 def actions_keyboard(member_id: int, vacation: int):
     vac_mark = "🏖 выключить" if vacation else "🏖 отпуск"
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Посетил(а)", callback_data=f"act_came_{member_id}")],
-        [InlineKeyboardButton(text="❌ Пропустил(а)", callback_data=f"act_miss_{member_id}")],
-        [InlineKeyboardButton(text="💰 Оплата", callback_data=f"act_renew_{member_id}")],
-        [InlineKeyboardButton(text="✏️ Изменить пакет", callback_data=f"act_edit_{member_id}")],
-        [InlineKeyboardButton(text="🔄 Отменить последнее", callback_data=f"act_undo_{member_id}")],
-        [InlineKeyboardButton(text=vac_mark, callback_data=f"act_vac_{member_id}")],
+        [InlineKeyboardButton(text="✅ Посетил(а)", callback_data=ActionCb(act=Act.came, id=member_id).pack())],
+        [InlineKeyboardButton(text="❌ Пропустил(а)", callback_data=ActionCb(act=Act.missed, id=member_id).pack())],
+        [InlineKeyboardButton(text="💰 Оплата", callback_data=ActionCb(act=Act.renew, id=member_id).pack())],
+        [InlineKeyboardButton(text="✏️ Изменить пакет", callback_data=ActionCb(act=Act.edit, id=member_id).pack())],
+        [InlineKeyboardButton(text="🔄 Отменить последнее", callback_data=ActionCb(act=Act.undo, id=member_id).pack())],
+        [InlineKeyboardButton(text=vac_mark, callback_data=ActionCb(act=Act.vacation, id=member_id).pack())],
         [InlineKeyboardButton(text="⬅️ Назад ко всем", callback_data="back_to_list")]
     ])
 # ---------- ГЛАВНОЕ МЕНЮ ----------
@@ -143,8 +2055,10 @@ RU_MONTHS = [
     "Июль","Август","Сентябрь","Октябрь","Ноябрь","Декабрь"
 ]
 
-def make_calendar(year: int = None, month: int = None) -> InlineKeyboardMarkup:
-    """Инлайн-календарь с навигацией"""
+WEEK = calmod.Calendar(calmod.MONDAY)
+
+def make_calendar(year: int = None, month: int = None, marked=frozenset()) -> InlineKeyboardMarkup:
+    """Инлайн-календарь с навигацией; дни из marked помечаются точкой"""
     today = dt.date.today()
     year = year or today.year
     month = month or today.month
@@ -160,15 +2074,15 @@ def make_calendar(year: int = None, month: int = None) -> InlineKeyboardMarkup:
     kb.append([InlineKeyboardButton(text=d, callback_data="calnoop") for d in week])
 
     # Сетка дней
-    calmod.setfirstweekday(calmod.MONDAY)
-    for wk in calmod.monthcalendar(year, month):
+    for wk in WEEK.monthdayscalendar(year, month):
         row = []
         for d in wk:
             if d == 0:
                 row.append(InlineKeyboardButton(text=" ", callback_data="calnoop"))
             else:
                 date_str = f"{year:04d}-{month:02d}-{d:02d}"
-                row.append(InlineKeyboardButton(text=str(d), callback_data=f"cal:{date_str}"))
+                text = f"•{d}" if d in marked else str(d)
+                row.append(InlineKeyboardButton(text=text, callback_data=f"cal:{date_str}"))
         kb.append(row)
 
     # Навигация по месяцам
@@ -182,102 +2096,156 @@ def make_calendar(year: int = None, month: int = None) -> InlineKeyboardMarkup:
 
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+# номер дня epoch (dt // 86400) + EPOCH_ORDINAL = date.toordinal()
+EPOCH_ORDINAL = dt.date(1970, 1, 1).toordinal()
+
+class CalendarCache:
+    """LRU отрисованных месяцев с отметками посещений.
+
+    Ключ — (год, месяц, версия журнала); любое изменение visits сдвигает версию,
+    и старые сетки просто вытесняются из LRU.
+    """
+
+    def __init__(self, maxsize: int = CALENDAR_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.version = 0
+        self.stats = Counter()
+        self._grids = OrderedDict()
+
+    def bump(self):
+        self.version += 1
+
+    def clear(self):
+        self._grids.clear()
+        self.bump()
+
+    async def get(self, db, year: int, month: int) -> InlineKeyboardMarkup:
+        key = (year, month, self.version)
+        kb = self._grids.get(key)
+        if kb is not None:
+            self.stats["hit"] += 1
+            self._grids.move_to_end(key)
+            return kb
+        self.stats["miss"] += 1
+        first = dt.date(year, month, 1)
+        last = (first + dt.timedelta(days=31)).replace(day=1)
+        # суточные сводки переживают архивацию журнала
+        async with db.execute(
+            "SELECT DISTINCT day FROM daily_stats WHERE day >= ? AND day < ? AND came + missed > 0",
+            (day_start(first) // 86400, day_start(last) // 86400),
+        ) as c:
+            marked = frozenset(dt.date.fromordinal(EPOCH_ORDINAL + row[0]).day for row in await c.fetchall())
+        kb = self._grids[key] = make_calendar(year, month, marked)
+        while len(self._grids) > self.maxsize:
+            self._grids.popitem(last=False)
+        return kb
+
+calendar_cache = TenantLocal("calendar")
+
+async def attendance_on(db, day: dt.date):
+    """[(имя, пришёл, пропустил)] за сутки из суточных сводок."""
+    async with db.execute(
+        "SELECT m.name, d.came, d.missed FROM daily_stats d JOIN members m ON m.id = d.member_id "
+        "WHERE d.day = ? AND d.came + d.missed > 0 ORDER BY m.name",
+        (day_start(day) // 86400,),
+    ) as c:
+        return await c.fetchall()
+
 # ---------- КОМАНДЫ ----------
 @dp.message(Command("start"))
 async def start(m: Message):
-    await ensure_db()
     await m.answer(
         "Привет! Я отмечаю посещения и тренировки 💪\n\n"
         "Команды:\n"
         "/status Имя — остаток тренировок\n"
         "/list — список всех\n"
+        "/group — отметить сразу всю группу\n"
+        "@бот Имя — поиск ученика (inline-режим)\n"
         "/renew Имя [кол-во] — продлить тренировки\n"
         "/edit Имя [кол-во] — изменить пакет\n"
-        "/backup — создать бэкап базы (.db)\n"
-        "/export — выгрузить журнал посещений (CSV)\n"
+        "/stats [Имя] — статистика посещений зала или ученика\n"
+        "/remind on|off|now — ежедневные напоминания об остатках и пропусках\n"
+        "/backup — создать бэкап базы (.db.gz)\n"
+        "/archive — свернуть старые отметки и уплотнить базу\n"
+        "/export [с] [по] [Имя] — выгрузить журнал посещений (CSV.gz)\n"
+        "/export new — только новые записи с прошлой выгрузки\n"
+        "/import — загрузить учеников и журнал из CSV (файл с подписью /import)\n"
         "/dbpath — показать путь к БД\n"
+        "/cachestats — статистика кэша учеников\n"
+        "/tenants — базы тренеров и их размеры (админ)\n"
+        "/metrics — задержки хендлеров, SQL и Bot API\n"
         "/restore — восстановить базу (пришлите .db с подписью /restore)",
         reply_markup=main_menu_kb(),
     )
 
 @dp.message(Command("add"))
-async def add(m: Message):
+async def add(m: Message, pool: DBPool):
     parts = m.text.split()
     if len(parts) < 2:
         return await m.answer("Формат: /add Имя [кол-во тренировок]. Пример: /add Роман 12")
     name = parts[1]
     trainings = int(parts[2]) if len(parts) >= 3 and parts[2].isdigit() else 12
-    await ensure_db()
-    async with aiosqlite.connect(DB) as db:
-        try:
-            await db.execute(
-                "INSERT INTO members(name, trainings_total, remaining) VALUES(?,?,?)",
-                (name, trainings, trainings),
-            )
-            await db.commit()
-            await m.answer(f"Добавлен {name}, {trainings} тренировок.")
-        except Exception:
-            await m.answer(f"{name} уже есть в списке.")
+    try:
+        await pool.submit(lambda db: add_member(db, name, trainings))
+    except aiosqlite.IntegrityError:
+        return await m.answer(f"{name} уже есть в списке.")
+    await m.answer(f"Добавлен {name}, {trainings} тренировок.")
 
 @dp.message(Command("visit"))
-async def visit(m: Message):
-    await ensure_db()
-    async with aiosqlite.connect(DB) as db:
+async def visit(m: Message, pool: DBPool):
+    async with pool.read() as db:
         members = await get_all_members(db)
     if not members:
         return await m.answer("Пока нет учеников. Добавьте: /add Имя 12")
-    await m.answer("Кого отмечаем сегодня?", reply_markup=members_keyboard(members))
+    await m.answer("Кого отмечаем сегодня?", reply_markup=members_cache.keyboard())
 
 @dp.message(Command("list"))
-async def cmd_list(m: Message):
-    await ensure_db()
-    async with aiosqlite.connect(DB) as db:
+async def cmd_list(m: Message, pool: DBPool):
+    async with pool.read() as db:
         members = await get_all_members(db)
     if not members:
         return await m.answer("Список пуст. /add Имя 12")
-    def line(name, rem, total, vac):
-        tail = " 🏖" if vac else ""
-        return f"{name} — {rem}/{total}{tail}"
-    lines = [line(name, rem, total, vac) for _id, name, rem, total, vac in members]
-    await m.answer("Список учеников:\n" + "\n".join(lines))
+    await m.answer(members_cache.list_text())
+
+async def answer_not_found(m: Message, name: str, candidates, text: str, act: Act = None, n: int = None):
+    if not candidates:
+        return await m.answer(text)
+    await m.answer(f"🔎 «{name}» не нашёл. Возможно:", reply_markup=candidates_keyboard(candidates, act, n))
 
 @dp.message(Command("status"))
-async def status(m: Message):
+async def status(m: Message, pool: DBPool):
     parts = m.text.split(maxsplit=1)
     if len(parts) < 2:
         return await m.answer("Формат: /status Имя")
-    name = parts[1]
-    await ensure_db()
-    async with aiosqlite.connect(DB) as db:
-        async with db.execute(
-            "SELECT remaining, trainings_total, vacation FROM members WHERE name=?", (name,)
-        ) as c:
-            row = await c.fetchone()
+    row, candidates = await find_member(pool, parts[1])
     if not row:
-        return await m.answer("Ученика не нашёл. /add Имя 12")
-    remaining, total, vacation = row
+        return await answer_not_found(m, parts[1], candidates, "Ученика не нашёл. /add Имя 12")
+    _id, name, remaining, total, vacation = row
     vac = " (🏖 отпуск)" if vacation else ""
     await m.answer(f"{name}: осталось {remaining} из {total} тренировок{vac}")
 
 @dp.message(Command("renew"))
-async def cmd_renew(m: Message):
+async def cmd_renew(m: Message, pool: DBPool):
     parts = m.text.split()
     if len(parts) < 2:
         return await m.answer("Формат: /renew Имя [кол-во тренировок]")
-    name = parts[1]
     trainings = int(parts[2]) if len(parts) >= 3 and parts[2].isdigit() else None
-    await ensure_db()
-    async with aiosqlite.connect(DB) as db:
-        async with db.execute("SELECT id FROM members WHERE name=?", (name,)) as c:
-            row = await c.fetchone()
-        if not row:
-            return await m.answer("Такого ученика нет. /add Имя [кол-во]")
-        member_id = row[0]
-        new_total = await renew_trainings(db, member_id, trainings)
-        await m.answer(f"🔁 Продлены тренировки: {name} — {new_total} занятий.")
+    row, candidates = await find_member(pool, parts[1])
+    if not row:
+        return await answer_not_found(
+            m, parts[1], candidates, "Такого ученика нет. /add Имя [кол-во]", Act.renew, trainings
+        )
+    await m.answer(await renew_reply(pool, row, trainings))
+
+async def renew_reply(pool: DBPool, row, trainings: int = None) -> str:
+    member_id, name = row[0], row[1]
+    new_total = await pool.submit(lambda db: renew_trainings(db, member_id, trainings))
+    if new_total is None:
+        return "Такого ученика нет. /add Имя [кол-во]"
+    return f"🔁 Продлены тренировки: {name} — {new_total} занятий."
 
 @dp.message(Command("edit"))
-async def cmd_edit(m: Message):
+async def cmd_edit(m: Message, pool: DBPool):
     parts = m.text.split()
     if len(parts) < 2:
         return await m.answer(
@@ -286,95 +2254,223 @@ async def cmd_edit(m: Message):
             "/edit Роман 20 - изменить пакет на 20\n"
             "/edit Роман - показать текущие данные"
         )
-    name = parts[1]
     new_trainings = int(parts[2]) if len(parts) >= 3 and parts[2].isdigit() else None
-    await ensure_db()
-    async with aiosqlite.connect(DB) as db:
-        async with db.execute(
-            "SELECT id, name, remaining, trainings_total FROM members WHERE name=?", (name,)
-        ) as c:
-            row = await c.fetchone()
-        if not row:
-            return await m.answer(f"❌ Ученик '{name}' не найден")
-        member_id, current_name, current_remaining, current_total = row
-        if new_trainings is not None:
-            await db.execute(
-                "UPDATE members SET trainings_total=?, remaining=? WHERE id=?",
-                (new_trainings, new_trainings, member_id)
-            )
-            await db.commit()
-            await m.answer(
-                f"✅ Обновлено: {name}\n"
-                f"📊 Было: {current_total}\n"
-                f"📊 Стало: {new_trainings}\n"
-                f"💫 Остаток обновлён до: {new_trainings}"
-            )
-        else:
-            await m.answer(
-                f"📊 {name}:\n"
-                f"• Всего тренировок: {current_total}\n"
-                f"• Осталось: {current_remaining}\n"
-                f"• Использовано: {current_total - current_remaining}\n\n"
-                f"Чтобы изменить: /edit {name} [новое_число]"
-            )
+    row, candidates = await find_member(pool, parts[1])
+    if not row:
+        return await answer_not_found(
+            m, parts[1], candidates, f"❌ Ученик '{parts[1]}' не найден", Act.edit, new_trainings
+        )
+    await m.answer(await edit_reply(pool, row, new_trainings))
+
+async def edit_reply(pool: DBPool, row, new_trainings: int = None) -> str:
+    member_id, name, current_remaining, current_total, _vac = row
+    if new_trainings is not None:
+        await pool.submit(lambda db: renew_trainings(db, member_id, new_trainings, count_renewal=False))
+        return (
+            f"✅ Обновлено: {name}\n"
+            f"📊 Было: {current_total}\n"
+            f"📊 Стало: {new_trainings}\n"
+            f"💫 Остаток обновлён до: {new_trainings}"
+        )
+    else:
+        return (
+            f"📊 {name}:\n"
+            f"• Всего тренировок: {current_total}\n"
+            f"• Осталось: {current_remaining}\n"
+            f"• Использовано: {current_total - current_remaining}\n\n"
+            f"Чтобы изменить: /edit {name} [новое_число]"
+        )
+
+@dp.message(Command("stats"))
+async def cmd_stats(m: Message, pool: DBPool):
+    parts = m.text.split(maxsplit=1)
+    today = int(time.time()) // 86400
+    if len(parts) < 2:
+        async with pool.read() as db:
+            text = await gym_stats(db, today)
+        return await m.answer(text)
+    row, candidates = await find_member(pool, parts[1])
+    if not row:
+        return await answer_not_found(m, parts[1], candidates, "Ученика не нашёл. /add Имя 12")
+    async with pool.read() as db:
+        text = await member_stats(db, row, today)
+    await m.answer(text)
+
+@dp.message(Command("remind"))
+async def cmd_remind(m: Message, pool: DBPool):
+    arg = m.text.split(maxsplit=1)[1].strip().lower() if " " in m.text else ""
+    today = int(time.time()) // 86400
+    if arg == "on":
+        await pool.submit(lambda db: set_meta(db, "remind_chat", m.chat.id))
+        remind_state.pop(pool.path, None)
+        return await m.answer(
+            f"🔔 Напоминания включены: каждый день после {REMIND_HOUR}:00 UTC — "
+            f"остаток ≤ {REMIND_LOW_LEFT} и пропуски {REMIND_IDLE_DAYS}+ дн."
+        )
+    if arg == "off":
+        await pool.submit(lambda db: set_meta(db, "remind_chat", 0))
+        remind_state.pop(pool.path, None)
+        return await m.answer("🔕 Напоминания выключены.")
+    if arg == "now":
+        if not await send_reminders(pool, send_queue, today, force=True):
+            await m.answer("🔔 Напоминать не о ком (или напоминания выключены: /remind on).")
+        return
+    async with pool.read() as db:
+        chat_id = await get_meta(db, "remind_chat")
+    await m.answer(
+        f"🔔 Напоминания {'включены' if chat_id else 'выключены'}.\n"
+        "/remind on | off — включить или выключить\n"
+        "/remind now — прислать сейчас"
+    )
+
+@dp.message(Command("archive"))
+async def cmd_archive(m: Message, pool: DBPool):
+    size_before = os.path.getsize(pool.path)
+    moved, freed = await run_archive(pool)
+    await m.answer(
+        f"🗄 Архив: свернуто отметок старше {ARCHIVE_AFTER_DAYS} дн.: {moved}\n"
+        f"Освобождено страниц: {freed}\n"
+        f"Размер базы: {human_size(size_before)} → {human_size(os.path.getsize(pool.path))}"
+    )
 
 @dp.message(Command("backup"))
-async def cmd_backup(m: Message):
-    await ensure_db()
-    ts = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_name = f"gym_backup_{ts}.db"
-    backup_path = os.path.join(DATA_DIR, backup_name)
-    shutil.copy2(DB, backup_path)
-    await m.answer_document(FSInputFile(backup_path), caption="📦 Резервная копия базы")
+async def cmd_backup(m: Message, pool: DBPool):
+    path, size, took = await make_backup(pool)
+    await m.answer_document(
+        FSInputFile(path),
+        caption=f"📦 Резервная копия базы: {human_size(size)}, {took:.2f} с",
+    )
 
 @dp.message(Command("export"))
-async def cmd_export(m: Message):
-    await ensure_db()
-    csv_path = os.path.join(DATA_DIR, f"visits_{dt.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
-    async with aiosqlite.connect(DB) as db, open(csv_path, "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow(["member_id", "member_name", "dt", "status", "remaining", "trainings_total", "vacation"])
-        async with db.execute("""
-            SELECT v.member_id, m.name, v.dt, v.status, m.remaining, m.trainings_total, m.vacation
-            FROM visits v
-            LEFT JOIN members m ON m.id = v.member_id
-            ORDER BY v.id
-        """) as c:
-            async for row in c:
-                w.writerow(row)
-    await m.answer_document(FSInputFile(csv_path), caption="📤 Экспорт журнала посещений")
+async def cmd_export(m: Message, pool: DBPool):
+    try:
+        since, until, name, incremental = parse_export_args(m.text.split()[1:])
+    except ValueError:
+        return await m.answer(
+            "Формат: /export [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [Имя]\n"
+            "/export new — только записи после прошлой выгрузки"
+        )
+    member_id = None
+    if name:
+        async with pool.read() as db:
+            row = await get_member_by_name(db, name)
+        if not row:
+            return await m.answer(f"❌ Ученик '{name}' не найден")
+        member_id = row[0]
+
+    # файл на /data не создаётся: до EXPORT_SPOOL_BYTES всё в памяти, дальше — во временном каталоге
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as out:
+        async with pool.read() as db:
+            after_id = int(await get_meta(db, "export_watermark", 0)) if incremental else 0
+            count, last_id = await export_visits(db, out, since, until, member_id, after_id)
+        if not count:
+            return await m.answer("📤 Нет записей для выгрузки.")
+        ts = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+        await m.answer_document(
+            SpooledInputFile(out, f"visits_{ts}.csv.gz"),
+            caption=f"📤 Экспорт журнала посещений: {count} записей",
+        )
+    # полная или инкрементальная выгрузка сдвигает водяной знак
+    if incremental or (since is None and until is None and member_id is None):
+        await pool.submit(lambda db: set_meta(db, "export_watermark", last_id))
+
+@dp.message(Command("cachestats"))
+async def cmd_cachestats(m: Message):
+    st = members_cache.stats
+    await m.answer(
+        f"🗃 Кэш учеников: {len(members_cache.by_id)} записей\n"
+        f"Строки: {st['hit']} попаданий / {st['miss']} промахов\n"
+        f"Клавиатура и /list: {st['render_hit']} попаданий / {st['render_miss']} промахов"
+    )
+
+@dp.message(Command("metrics"))
+async def cmd_metrics(m: Message, pool: DBPool, tenants: TenantPools = None, fsm_storage: BaseStorage = None):
+    if not is_admin(m.from_user):
+        return await m.answer("⛔ Команда только для администратора.")
+
+    def row(name, t):
+        p50, p95, p99 = (v * 1000 for v in t.quantiles())
+        return f"{name}: {t.count} × p50 {p50:.1f} / p95 {p95:.1f} / p99 {p99:.1f} мс"
+
+    lines = ["📈 Метрики (мс, по последним замерам)", ""]
+    if metrics.startup:
+        lines += ["Запуск: " + ", ".join(f"{k} {v * 1000:.0f}" for k, v in metrics.startup.items()), ""]
+    lines.append("Апдейты:")
+    lines += [row(k, t) for k, t in sorted(metrics.updates.items())]
+    if metrics.callbacks:
+        lines.append("Кнопки: " + ", ".join(f"{k} {n}" for k, n in metrics.callbacks.most_common()))
+    lines += ["", "Хендлеры:"]
+    lines += [row(k, t) for k, t in sorted(metrics.handlers.items(), key=lambda kv: -kv[1].total)[:15]]
+    if metrics.errors:
+        lines.append("Ошибки: " + ", ".join(f"{k} {n}" for k, n in metrics.errors.most_common()))
+    lines += ["", "SQL (по суммарному времени):"]
+    lines += [row(k, t) for k, t in sorted(metrics.sql.items(), key=lambda kv: -kv[1].total)[:8]]
+    lines += ["", "Bot API:"]
+    lines += [row(k, t) for k, t in sorted(metrics.api.items(), key=lambda kv: -kv[1].total)[:8]]
+    lines += ["", f"Запись: {pool.stats['ops']} изменений в {pool.stats['batches']} транзакциях"]
+    if tenants is not None and tenants.multi:
+        lines.append("Пулы арендаторов: " + ", ".join(f"{k} {n}" for k, n in sorted(tenants.stats.items())))
+    fsm_stats = getattr(fsm_storage, "stats", None)
+    if fsm_stats:
+        lines.append("FSM: " + ", ".join(f"{k} {n}" for k, n in sorted(fsm_stats.items())))
+    await m.answer("\n".join(lines)[:4096])
 
 @dp.message(Command("dbpath"))
-async def cmd_dbpath(m: Message):
-    await m.answer(f"DB path: `{DB}`\nDATA_DIR: `{DATA_DIR}`", parse_mode="Markdown")
+async def cmd_dbpath(m: Message, pool: DBPool):
+    await m.answer(f"DB path: `{pool.path}`\nDATA_DIR: `{DATA_DIR}`", parse_mode="Markdown")
+
+@dp.message(Command("tenants"))
+async def cmd_tenants(m: Message, tenants: TenantPools = None):
+    if not is_admin(m.from_user, strict=True):
+        return await m.answer("⛔ Команда только для администратора (задайте ADMIN_IDS).")
+    if tenants is None or not tenants.multi:
+        return await m.answer("🏢 Режим арендаторов выключен (MULTI_TENANT=1), все чаты в общей базе.")
+    rows = []
+    for key in tenants.known():
+        path = tenants.path(key)
+        size = sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+        rows.append((size, key, tenants.is_open(key)))
+    rows.sort(reverse=True)
+    lines = [
+        f"🏢 Арендаторов: {len(rows)}, открыто {len(tenants.open_pools())} из {tenants.max_open}, "
+        f"всего {human_size(sum(r[0] for r in rows))}",
+        "LRU: " + (", ".join(f"{k} {n}" for k, n in sorted(tenants.stats.items())) or "событий нет"),
+    ]
+    lines += [f"{'🟢' if is_open else '⚪️'} {key or 'общая'} — {human_size(size)}"
+              for size, key, is_open in rows[:50]]
+    if len(rows) > 50:
+        lines.append(f"… и ещё {len(rows) - 50}")
+    await m.answer("\n".join(lines))
 
 # --- ВОССТАНОВЛЕНИЕ БД ---
 @dp.message(Command("restore"))
-async def cmd_restore(m: Message):
+async def cmd_restore(m: Message, pool: DBPool):
     """Инструкция и восстановление, если файл приложен без подписи."""
     if not m.document:
         return await m.answer(
             "🔄 Для восстановления базы:\n"
-            "1) Отправь файл .db с подписью `/restore`\n"
-            "2) Я заменю текущую базу и перезапущу бота\n\n"
+            "1) Отправь файл .db или .db.gz с подписью `/restore`\n"
+            "2) Я проверю файл и подменю текущую базу без перезапуска бота\n\n"
             "⚠️ Все текущие данные будут заменены."
         )
     # если прислали как /restore + файл (без подписи к самому документу)
-    if not m.document.file_name.endswith(".db"):
-        return await m.answer("✗ Файл должен быть .db")
-    await _do_restore_from_document(m, m.document.file_name)
+    if not m.document.file_name.endswith(BACKUP_EXTS):
+        return await m.answer("✗ Файл должен быть .db или .db.gz")
+    await _do_restore_from_document(m, m.document.file_name, pool)
 
 @dp.message(F.document & (F.caption.startswith("/restore")))
-async def restore_with_caption(m: Message):
+async def restore_with_caption(m: Message, pool: DBPool):
     """Восстановление, если к файлу приложена подпись /restore."""
-    if not m.document.file_name.endswith(".db"):
-        return await m.answer("✗ Файл должен быть .db")
-    await _do_restore_from_document(m, m.document.file_name)
+    if not m.document.file_name.endswith(BACKUP_EXTS):
+        return await m.answer("✗ Файл должен быть .db или .db.gz")
+    await _do_restore_from_document(m, m.document.file_name, pool)
 
 @dp.message(F.document & ~F.caption)
 async def restore_document_without_caption(m: Message):
-    if not m.document.file_name.endswith(".db"):
-        return await m.answer("✗ Файл должен быть .db")
+    if m.document.file_name.lower().endswith(IMPORT_EXTS):
+        return await m.answer("Чтобы загрузить этот CSV, отправь его с подписью `/import`", parse_mode="Markdown")
+    if not m.document.file_name.endswith(BACKUP_EXTS):
+        return await m.answer("✗ Файл должен быть .db или .db.gz")
     await m.answer(
         "Я получил файл базы.\n"
         "Чтобы восстановить его, отправь этот же файл с подписью:\n\n"
@@ -382,22 +2478,97 @@ async def restore_document_without_caption(m: Message):
         parse_mode="Markdown"
     )
 
-async def _do_restore_from_document(m: Message, file_name: str):
+@dp.message(Command("import"))
+async def cmd_import(m: Message, pool: DBPool):
+    """Импорт из CSV: файл с подписью /import."""
+    if not m.document:
+        return await m.answer(
+            "📥 Импорт: отправь .csv или .csv.gz с подписью `/import`\n\n"
+            "• журнал — в формате /export (member_name, dt, status, …)\n"
+            f"• только ученики — колонки {', '.join(IMPORT_MEMBERS_HEADER)}\n\n"
+            "Ученики обновляются по имени, журнал грузится только для новых.",
+            parse_mode="Markdown",
+        )
+    if not m.document.file_name.lower().endswith(IMPORT_EXTS):
+        return await m.answer("✗ Файл должен быть .csv или .csv.gz")
+    tmp_path = os.path.join(DATA_DIR, f".import_{m.document.file_unique_id}")
+    try:
+        await m.bot.download(m.document, destination=tmp_path)
+        with open(tmp_path, "rb") as raw:
+            gzipped = raw.read(2) == b"\x1f\x8b"
+        opener = gzip.open if gzipped else open
+        started = time.monotonic()
+        with opener(tmp_path, "rt", encoding="utf-8-sig", newline="") as f:
+            reader = csv.reader(f)
+            header = [h.strip().lower() for h in next(reader, [])]
+            if not ("member_name" in header and "status" in header) and "name" not in header:
+                return await m.answer(
+                    "✗ Не узнал формат: нужна шапка как в /export или "
+                    + ",".join(IMPORT_MEMBERS_HEADER)
+                )
+            stats, rejects = await pool.submit(lambda db: import_csv(db, reader, header))
+        await reload_caches(pool)
+    except (UnicodeDecodeError, OSError, EOFError) as e:
+        return await m.answer(f"✗ Не удалось прочитать файл: {e}")
+    except csv.Error as e:
+        # шапка разбирается до import_csv: NUL-байт, слишком длинное поле
+        return await m.answer(f"✗ Не удалось разобрать CSV: {e}")
+    except sqlite3.Error as e:
+        # импорт — одна операция группового коммита: при ошибке откатывается целиком
+        return await m.answer(f"✗ Ошибка базы, ничего не загружено: {e}")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    text = f"📥 Импорт за {time.monotonic() - started:.1f} с\n"
+    if "status" in header:
+        text += f"Ученики: +{stats['members_added']} новых, {stats['members_kept']} уже были — не тронуты\n"
+        text += f"Отметки: {stats['visits']} загружено, {stats['visits_skipped']} пропущено (ученик уже был)\n"
+    else:
+        text += f"Ученики: +{stats['members_added']} новых, {stats['members_updated']} обновлено\n"
+    text += f"Отклонено строк: {stats['rejected']}"
+    if rejects:
+        text += "\n" + "\n".join(f"• стр. {line}: {reason}" for line, reason in rejects)
+        if stats["rejected"] > len(rejects):
+            text += f"\n… и ещё {stats['rejected'] - len(rejects)}"
+    await m.answer(text[:4096])
+
+async def _do_restore_from_document(m: Message, file_name: str, pool: DBPool):
+    # временный файл на том же томе, что и БД, — подмена будет атомарным rename
+    tmp_path = os.path.join(DATA_DIR, f".restore_{m.document.file_unique_id}.db")
+    gz_path = tmp_path + ".gz"
     try:
         await m.answer("🔄 Восстанавливаю базу из бэкапа...")
-        file_path = os.path.join(DATA_DIR, f"restored_{file_name}")
-        await bot.download(m.document, destination=file_path)
-        shutil.copy2(file_path, DB)
-        os.remove(file_path)
-        await m.answer("✅ База восстановлена. Перезапускаю бота…")
-        import sys
-        os.execv(sys.executable, [sys.executable] + sys.argv)
+        if file_name.endswith(".gz"):
+            await m.bot.download(m.document, destination=gz_path)
+            await asyncio.to_thread(_gunzip_file, gz_path, tmp_path)
+        else:
+            await m.bot.download(m.document, destination=tmp_path)
+        version = await asyncio.to_thread(check_db_file, tmp_path)
+        # страховочная копия текущей базы
+        await make_backup(pool)
+        started = time.monotonic()
+        await pool.swap(tmp_path)
+        await reload_caches(pool)
+        remind_state.pop(pool.path, None)
+        took_ms = (time.monotonic() - started) * 1000
+        await m.answer(
+            f"✅ База восстановлена (схема v{version}"
+            + (f" → v{SCHEMA_VERSION}" if version != SCHEMA_VERSION else "")
+            + f"), подмена заняла {took_ms:.0f} мс."
+        )
     except Exception as e:
         await m.answer(f"✗ Ошибка при восстановлении: {e}")
+    finally:
+        for path in (tmp_path, gz_path):
+            if os.path.exists(path):
+                os.remove(path)
 # ---------- СОСТОЯНИЯ ----------
 class AddStates(StatesGroup):
     waiting_name_and_count = State()
 
+class BatchStates(StatesGroup):
+    selecting = State()
+
 
 # ---------- ОБРАБОТЧИК КНОПКИ "➕ Добавить" ----------
 @dp.message(F.text == "➕ Добавить подопечного")
@@ -411,7 +2582,7 @@ async def add_via_button(m: Message, state: FSMContext):
     )
     
 @dp.message(AddStates.waiting_name_and_count)
-async def add_via_button_collect(m: Message, state: FSMContext):
+async def add_via_button_collect(m: Message, state: FSMContext, pool: DBPool):
     parts = m.text.split()
     if not parts:
         return await m.answer("Пусто. Напиши: Имя [кол-во]. Например: Роман 12")
@@ -419,148 +2590,442 @@ async def add_via_button_collect(m: Message, state: FSMContext):
     name = parts[0]
     trainings = int(parts[1]) if len(parts) >= 2 and parts[1].isdigit() else 12
 
-    await ensure_db()
     try:
-        async with aiosqlite.connect(DB) as db:
-            await db.execute(
-                "INSERT INTO members(name, trainings_total, remaining) VALUES(?,?,?)",
-                (name, trainings, trainings),
-            )
-            await db.commit()
+        await pool.submit(lambda db: add_member(db, name, trainings))
         await m.answer(f"✅ Добавлен {name}, {trainings} тренировок.")
-    except Exception:
+    except aiosqlite.IntegrityError:
         await m.answer(f"⚠️ {name} уже есть в списке.")
 
     await state.clear()
 # ---------- ОБРАБОТЧИК КНОПКИ "✅ Отметить посещение" ----------
 @dp.message(F.text == "✅ Отметить посещение")
-async def visit_via_button(m: Message):
-    await ensure_db()
-    async with aiosqlite.connect(DB) as db:
+async def visit_via_button(m: Message, pool: DBPool):
+    async with pool.read() as db:
         members = await get_all_members(db)
     if not members:
         return await m.answer("Пока нет учеников. Добавьте: ➕ Добавить")
-    await m.answer("Кого отмечаем сегодня?", reply_markup=members_keyboard(members))
+    await m.answer("Кого отмечаем сегодня?", reply_markup=members_cache.keyboard())
 # ---------- ОБРАБОТЧИКИ КНОПОК ----------
-@dp.callback_query(
-    F.data.startswith("member_") |
-    F.data.startswith("act_") |
-    (F.data == "back_to_list")
-)
-async def handle_member_and_actions(cb: CallbackQuery):
+async def edit_markup_quiet(cb: CallbackQuery, kb: InlineKeyboardMarkup, text: str = None):
+    """Правит клавиатуру (и текст, если задан) сообщения с кнопкой.
+
+    Повторное нажатие даёт то же самое сообщение — Telegram отвечает
+    «message is not modified», это не ошибка.
+    """
     try:
-        await ensure_db()
-        async with aiosqlite.connect(DB) as db:
-            # Назад к списку
-            if cb.data == "back_to_list":
-                members = await get_all_members(db)
-                await cb.message.edit_text("Кого отмечаем сегодня?", reply_markup=members_keyboard(members))
-                return await cb.answer()
-
-            # Подменю по ученику
-            if cb.data.startswith("member_"):
-                member_id = int(cb.data.split("_", 1)[1])
-                row = await get_member_by_id(db, member_id)
-                if not row:
-                    return await cb.answer("Не нашёл ученика", show_alert=True)
-                _id, name, rem, total, vac = row
-                text = f"Выбран: {name} — {rem}/{total} тренировок" + (" 🏖" if vac else "")
-                await cb.message.edit_text(text, reply_markup=actions_keyboard(member_id, vac))
-                return await cb.answer()
-
-            # Действия
-            if cb.data.startswith("act_"):
-                _, action, member_id_s = cb.data.split("_", 2)
-                member_id = int(member_id_s)
-
-                row = await get_member_by_id(db, member_id)
-                if not row:
-                    return await cb.answer("Не нашёл ученика", show_alert=True)
-                _id, name, rem, total, vac = row
-
-                if action in ("came", "miss"):
-                    came = action == "came"
-                    await change_visit(db, member_id, came)
-                    _id, name, rem, total, vac = await get_member_by_id(db, member_id)
-                    msg = f"{'✅ Посетил(а)' if came else '❌ Пропустил(а)'}: {name}. Осталось {rem}/{total}"
-                    if came and not vac and rem in (2, 1):
-                        msg += f"\n⚠️ Осталось {rem} {'тренировка' if rem==1 else 'тренировки'}!"
-                    if came and not vac and rem == 0:
-                        msg += "\n⛔ Тренировки закончились!"
-                    if vac:
-                        msg += "\n🏖 В отпуске — не списано."
-                    await cb.answer(msg, show_alert=True)
-
-                elif action == "renew":
-                    await renew_trainings(db, member_id, None)
-                    _id, name, rem, total, vac = await get_member_by_id(db, member_id)
-                    await cb.answer(f"💰 Продлены тренировки: {name} — {total} занятий.", show_alert=True)
-
-                elif action == "edit":
-                    await cb.answer(
-                        f"✏️ Редактирование: {name}\n"
-                        f"Текущий пакет: {total}\n"
-                        f"Отправь: /edit {name} [новое_число]",
-                        show_alert=True
-                    )
-
-                elif action == "undo":
-                    name2, err = await undo_last(db, member_id)
-                    if err:
-                        await cb.answer(f"🔄 {err}", show_alert=True)
-                    else:
-                        _id, _nm, rem, total, vac = await get_member_by_id(db, member_id)
-                        await cb.answer(f"🔄 Отмена: {name2}. Остаток {rem}/{total}.", show_alert=True)
-
-                elif action == "vac":
-                    new_vac = 0 if vac else 1
-                    await db.execute("UPDATE members SET vacation=? WHERE id=?", (new_vac, member_id))
-                    await db.commit()
-                    await cb.answer(f"🏖 Отпуск для {name}: {'включён' if new_vac else 'выключен'}.", show_alert=True)
-
-                # Обновляем подменю
-                _id, name, rem, total, vac = await get_member_by_id(db, member_id)
-                text = f"Выбран: {name} — {rem}/{total} тренировок" + (" 🏖" if vac else "")
-                try:
-                    await cb.message.edit_text(text, reply_markup=actions_keyboard(member_id, vac))
-                except Exception as e:
-                    if "message is not modified" not in str(e).lower():
-                        raise
-                return await cb.answer()
+        if text is None:
+            await cb.message.edit_reply_markup(reply_markup=kb)
+        else:
+            await cb.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in e.message.lower():
+            raise
+
+async def show_member(cb: CallbackQuery, row):
+    _id, name, rem, total, vac = row
+    text = f"Выбран: {name} — {rem}/{total} тренировок" + (" 🏖" if vac else "")
+    await edit_markup_quiet(cb, actions_keyboard(_id, vac), text)
+
+# Кнопки старого формата (member_<id>, act_<действие>_<id>) в уже отправленных
+# сообщениях просто возвращают к списку
+@dp.callback_query((F.data == "back_to_list") | F.data.startswith(("member_", "act_")))
+async def back_to_list(cb: CallbackQuery, pool: DBPool):
+    async with pool.read() as db:
+        await get_all_members(db)
+    await cb.message.edit_text("Кого отмечаем сегодня?", reply_markup=members_cache.keyboard())
+    await cb.answer()
+
+@dp.callback_query(MemberCb.filter())
+async def pick_member(cb: CallbackQuery, callback_data: MemberCb, pool: DBPool):
+    async with pool.read() as db:
+        row = await get_member_by_id(db, callback_data.id)
+    if not row:
+        return await cb.answer("Не нашёл ученика", show_alert=True)
+    await show_member(cb, row)
+    await cb.answer()
+
+# Кандидат выбран: выполняем отложенную /renew или /edit с её числом
+PICK_REPLIES = {Act.renew: renew_reply, Act.edit: edit_reply}
+
+@dp.callback_query(PickCb.filter())
+async def pick_candidate(cb: CallbackQuery, callback_data: PickCb, pool: DBPool):
+    async with pool.read() as db:
+        row = await get_member_by_id(db, callback_data.id)
+    if not row:
+        return await cb.answer("Не нашёл ученика", show_alert=True)
+    reply = PICK_REPLIES.get(callback_data.act)
+    if reply is None:
+        await show_member(cb, row)
+    else:
+        await cb.message.edit_text(await reply(pool, row, callback_data.n))
+    await cb.answer()
+
+# Действие -> async fn(pool, row) -> текст всплывающего ответа
+ACTIONS = {}
 
+def action(act: Act):
+    def register(fn):
+        ACTIONS[act] = fn
+        return fn
+    return register
+
+@dp.callback_query(ActionCb.filter())
+async def member_action(cb: CallbackQuery, callback_data: ActionCb, pool: DBPool):
+    try:
+        async with pool.read() as db:
+            row = await get_member_by_id(db, callback_data.id)
+        if not row:
+            return await cb.answer("Не нашёл ученика", show_alert=True)
+        await cb.answer(await ACTIONS[callback_data.act](pool, row), show_alert=True)
+        # обновляем подменю
+        async with pool.read() as db:
+            await show_member(cb, await get_member_by_id(db, callback_data.id))
     except Exception as e:
         return await cb.answer(f"Ошибка: {e}", show_alert=True)
+
+async def _mark_visit(pool: DBPool, member_id: int, came: bool) -> str:
+    _id, name, rem, total, vac = await pool.submit(lambda db: change_visit(db, member_id, came))
+    msg = f"{'✅ Посетил(а)' if came else '❌ Пропустил(а)'}: {name}. Осталось {rem}/{total}"
+    if came and not vac and rem in (2, 1):
+        msg += f"\n⚠️ Осталось {rem} {'тренировка' if rem==1 else 'тренировки'}!"
+    if came and not vac and rem == 0:
+        msg += "\n⛔ Тренировки закончились!"
+    if vac:
+        msg += "\n🏖 В отпуске — не списано."
+    return msg
+
+@action(Act.came)
+async def act_came(pool: DBPool, row) -> str:
+    return await _mark_visit(pool, row[0], True)
+
+@action(Act.missed)
+async def act_missed(pool: DBPool, row) -> str:
+    return await _mark_visit(pool, row[0], False)
+
+@action(Act.renew)
+async def act_renew(pool: DBPool, row) -> str:
+    member_id, name = row[0], row[1]
+    total = await pool.submit(lambda db: renew_trainings(db, member_id, None))
+    return f"💰 Продлены тренировки: {name} — {total} занятий."
+
+@action(Act.edit)
+async def act_edit(pool: DBPool, row) -> str:
+    _id, name, rem, total, vac = row
+    return (
+        f"✏️ Редактирование: {name}\n"
+        f"Текущий пакет: {total}\n"
+        f"Отправь: /edit {name} [новое_число]"
+    )
+
+@action(Act.undo)
+async def act_undo(pool: DBPool, row) -> str:
+    member_id = row[0]
+    row, err = await pool.submit(lambda db: undo_last(db, member_id))
+    if err:
+        return f"🔄 {err}"
+    _id, name, rem, total, vac = row
+    return f"🔄 Отмена: {name}. Остаток {rem}/{total}."
+
+@action(Act.vacation)
+async def act_vacation(pool: DBPool, row) -> str:
+    member_id = row[0]
+    row = await pool.submit(lambda db: toggle_vacation(db, member_id))
+    if not row:
+        return "Не нашёл ученика"
+    _id, name, rem, total, vac = row
+    return f"🏖 Отпуск для {name}: {'включён' if vac else 'выключен'}."
+
+@dp.callback_query(F.data.startswith("page_") | F.data.startswith("letter_") | (F.data == "letters"))
+async def roster_nav(cb: CallbackQuery, pool: DBPool):
+    async with pool.read() as db:
+        await get_all_members(db)
+    if cb.data == "letters":
+        kb = letters_keyboard(members_cache.letters())
+    elif cb.data.startswith("page_"):
+        kb = members_cache.keyboard(int(cb.data.split("_", 1)[1]))
+    else:
+        letter, _, page = cb.data.split("_", 1)[1].rpartition("_")
+        kb = members_cache.keyboard(int(page), letter)
+    await edit_markup_quiet(cb, kb)
+    await cb.answer()
+
+@dp.callback_query(F.data.in_({"noop", "calnoop"}))
+async def noop(cb: CallbackQuery):
+    await cb.answer()
+
+# ---------- ПОИСК (INLINE-РЕЖИМ) ----------
+@dp.inline_query()
+async def inline_search(q: InlineQuery, pool: DBPool):
+    async with pool.read() as db:
+        await get_all_members(db)
+    results = [
+        InlineQueryResultArticle(
+            id=str(member_id),
+            title=name,
+            description=f"{rem}/{total} тренировок" + (" 🏖" if vac else ""),
+            input_message_content=InputTextMessageContent(message_text=f"/status {name}"),
+        )
+        for member_id, name, rem, total, vac in members_cache.search(q.query.strip(), limit=50)
+    ]
+    await q.answer(results, cache_time=5, is_personal=True)
+
+# ---------- ГРУППОВАЯ ОТМЕТКА ----------
+async def _batch_show(cb: CallbackQuery, pool: DBPool, selected, page: int):
+    # кэш мог сброситься (откат операции, restore) — перечитываем, а не рисуем пустой список
+    async with pool.read() as db:
+        members = await get_all_members(db)
+    await edit_markup_quiet(cb, batch_keyboard(members, selected, page))
+    await cb.answer()
+
+@dp.message(Command("group"))
+async def cmd_group(m: Message, state: FSMContext, pool: DBPool):
+    async with pool.read() as db:
+        members = await get_all_members(db)
+    if not members:
+        return await m.answer("Пока нет учеников. Добавьте: /add Имя 12")
+    await state.set_state(BatchStates.selecting)
+    await state.update_data(selected=[])
+    await m.answer("Отметьте пришедших и нажмите «Отметить»:", reply_markup=batch_keyboard(members, set()))
+
+@dp.callback_query(F.data == "batch_start")
+async def batch_start(cb: CallbackQuery, state: FSMContext, pool: DBPool):
+    async with pool.read() as db:
+        members = await get_all_members(db)
+    await state.set_state(BatchStates.selecting)
+    await state.update_data(selected=[])
+    await cb.message.edit_text("Отметьте пришедших и нажмите «Отметить»:",
+                               reply_markup=batch_keyboard(members, set()))
+    await cb.answer()
+
+@dp.callback_query(BatchStates.selecting, F.data.startswith("bt_"))
+async def batch_toggle(cb: CallbackQuery, state: FSMContext, pool: DBPool):
+    _, member_id, page = cb.data.split("_")
+    selected = set((await state.get_data()).get("selected", []))
+    selected ^= {int(member_id)}
+    await state.update_data(selected=sorted(selected))
+    await _batch_show(cb, pool, selected, int(page))
+
+@dp.callback_query(BatchStates.selecting, F.data.startswith("bp_"))
+async def batch_page(cb: CallbackQuery, state: FSMContext, pool: DBPool):
+    selected = set((await state.get_data()).get("selected", []))
+    await _batch_show(cb, pool, selected, int(cb.data.split("_", 1)[1]))
+
+@dp.callback_query(BatchStates.selecting, F.data == "batch_ok")
+async def batch_confirm(cb: CallbackQuery, state: FSMContext, pool: DBPool):
+    selected = (await state.get_data()).get("selected", [])
+    if not selected:
+        return await cb.answer("Никто не выбран", show_alert=True)
+    rows = await pool.submit(lambda db: mark_came_many(db, selected))
+    await state.clear()
+    lines, warnings = [], []
+    for _id, name, rem, total, vac in rows:
+        lines.append(f"{name} — {rem}/{total}" + (" 🏖 не списано" if vac else ""))
+        if not vac and rem in (2, 1):
+            warnings.append(f"⚠️ {name}: осталось {rem} {'тренировка' if rem == 1 else 'тренировки'}")
+        elif not vac and rem == 0:
+            warnings.append(f"⛔ {name}: тренировки закончились")
+    text = f"✅ Отмечено: {len(rows)}\n" + "\n".join(lines)
+    if warnings:
+        text += "\n\n" + "\n".join(warnings)
+    await cb.message.edit_text(text)
+    await cb.answer()
+
+@dp.callback_query(BatchStates.selecting, F.data == "batch_cancel")
+async def batch_cancel(cb: CallbackQuery, state: FSMContext, pool: DBPool):
+    await state.clear()
+    async with pool.read() as db:
+        await get_all_members(db)
+    await cb.message.edit_text("Кого отмечаем сегодня?", reply_markup=members_cache.keyboard())
+    await cb.answer("Отменено")
+
+@dp.callback_query(F.data.startswith("bt_") | F.data.startswith("bp_") | F.data.in_({"batch_ok", "batch_cancel"}))
+async def batch_expired(cb: CallbackQuery):
+    await cb.answer("Групповая отметка устарела. Начните заново: /group", show_alert=True)
+
 # ---------- ОБРАБОТЧИКИ КАЛЕНДАРЯ ----------
 
 @dp.message(Command("calendar"))
-async def cmd_calendar(m: Message):
+async def cmd_calendar(m: Message, pool: DBPool):
     today = dt.date.today()
-    await m.answer("Выберите дату:", reply_markup=make_calendar(today.year, today.month))
+    async with pool.read() as db:
+        kb = await calendar_cache.get(db, today.year, today.month)
+    await m.answer("Выберите дату (• — были отметки):", reply_markup=kb)
 
 @dp.callback_query(F.data.startswith("calnav:"))
-async def cal_nav(cb: CallbackQuery):
+async def cal_nav(cb: CallbackQuery, pool: DBPool):
     _, ym = cb.data.split(":", 1)
     y, m = ym.split("-")
     y, m = int(y), int(m)
-    await cb.message.edit_reply_markup(reply_markup=make_calendar(y, m))
+    async with pool.read() as db:
+        kb = await calendar_cache.get(db, y, m)
+    await cb.message.edit_reply_markup(reply_markup=kb)
     await cb.answer()
 
 @dp.callback_query(F.data == "caltoday")
-async def cal_today(cb: CallbackQuery):
+async def cal_today(cb: CallbackQuery, pool: DBPool):
     today = dt.date.today()
-    await cb.message.edit_reply_markup(reply_markup=make_calendar(today.year, today.month))
+    async with pool.read() as db:
+        kb = await calendar_cache.get(db, today.year, today.month)
+    await edit_markup_quiet(cb, kb)
     await cb.answer("Сегодня")
 
 @dp.callback_query(F.data.startswith("cal:"))
-async def cal_pick(cb: CallbackQuery):
+async def cal_pick(cb: CallbackQuery, pool: DBPool):
     _, date_str = cb.data.split(":", 1)
-    await cb.message.answer(f"Вы выбрали дату: {date_str}")
+    day = dt.date.fromisoformat(date_str)
+    async with pool.read() as db:
+        rows = await attendance_on(db, day)
+    came = [name for name, came, missed in rows if came]
+    missed = [name for name, came, missed in rows if missed]
+    text = f"📅 {date_str}\n"
+    if not rows:
+        text += "Отметок нет."
+    else:
+        text += f"✅ Пришли ({len(came)}): {', '.join(came) or '—'}\n"
+        text += f"❌ Пропустили ({len(missed)}): {', '.join(missed) or '—'}"
+    await cb.message.answer(text)
     await cb.answer()
 
+# ---------- ВЕБХУК ----------
+async def run_webhook(bot: Bot, stop: asyncio.Event = None):
+    """Принимает апдейты по HTTP вместо long polling до SIGINT/SIGTERM (или stop).
+
+    Telegram получает 200 сразу после постановки апдейта в обработку; одновременно
+    обрабатывается не больше WEBHOOK_MAX_INFLIGHT апдейтов, следующий запрос ждёт
+    свободного места, и Telegram сам придерживает доставку. При остановке сначала
+    закрывается приём, потом дожидаются начатые апдейты; очереди записи
+    дописывает tenants.close() в main().
+    """
+    from aiohttp import web
+
+    stop = stop or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    signals = []
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+            signals.append(sig)
+        except (NotImplementedError, RuntimeError):
+            pass
+    inflight = asyncio.Semaphore(WEBHOOK_MAX_INFLIGHT)
+    tasks = set()
+
+    async def process(update: Update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            log.exception("update %s failed", update.update_id)
+        finally:
+            inflight.release()
+
+    async def handle(request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception:
+            return web.Response(status=400)
+        await inflight.acquire()
+        task = asyncio.create_task(process(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await dp.emit_startup(bot=bot)
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=min(WEBHOOK_MAX_INFLIGHT, 100),
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        log.info("webhook on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        await stop.wait()
+    finally:
+        # вебхук не снимаем: пока бот перезапускается, апдейты копит Telegram
+        await runner.cleanup()
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=WEBHOOK_DRAIN_S)
+            for task in pending:
+                task.cancel()
+            if pending:
+                log.warning("webhook: %d updates cancelled on shutdown", len(pending))
+        await dp.emit_shutdown(bot=bot)
+        for sig in signals:
+            loop.remove_signal_handler(sig)
+
 # ---------- ЗАПУСК ----------
+# Всё выше — импорт модуля; main() добавляет к этому свои фазы
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+async def _timed(phase: str, coro):
+    started = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        metrics.startup[phase] = time.perf_counter() - started
+
 async def main():
-    await ensure_db()
-    await dp.start_polling(bot)
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN env var is missing")
+    started = time.perf_counter()
+    metrics.startup["imports"] = IMPORT_SECONDS
+    os.makedirs(DATA_DIR, exist_ok=True)
+    bot = Bot(BOT_TOKEN)
+    tenants = TenantPools()
+
+    async def warm_db():
+        # общая база: миграции и кэш учеников до первого апдейта
+        if not tenants.multi or os.path.exists(DB):
+            await tenants.get(0)
+
+    # рукопожатие с Telegram идёт параллельно с открытием базы;
+    # bot.me() кэширует ответ, и start_polling не повторяет getMe
+    handshake = [_timed("get_me", bot.me())]
+    if not WEBHOOK_URL:
+        # после работы на вебхуке getUpdates вернёт конфликт, пока его не снять
+        handshake.append(_timed("delete_webhook", bot.delete_webhook()))
+    tasks = []
+    metrics_runner = None
+    try:
+        me, *_ = await _timed("parallel", asyncio.gather(*handshake, _timed("db", warm_db())))
+        dp.update.outer_middleware(TenantMiddleware(tenants))
+        # состояния диалогов переживают перезапуск; сбрасываются на shutdown диспетчера
+        dp.fsm.storage = SQLiteStorage(tenants)
+        setup_metrics(dp, bot)
+        metrics_runner = await start_metrics_server(tenants, dp.fsm.storage) if METRICS_PORT else None
+        if BACKUP_INTERVAL_H > 0:
+            tasks.append(asyncio.create_task(backup_scheduler(tenants)))
+        if ARCHIVE_INTERVAL_H > 0:
+            tasks.append(asyncio.create_task(archive_scheduler(tenants)))
+        if tenants.multi:
+            tasks.append(asyncio.create_task(tenants.reaper()))
+        tasks.append(asyncio.create_task(send_queue.run(bot)))
+        tasks.append(asyncio.create_task(reminder_scheduler(tenants, send_queue)))
+        metrics.startup["main"] = time.perf_counter() - started
+        metrics.startup["total"] = time.perf_counter() - IMPORT_STARTED
+        log.info(
+            "ready as @%s in %.0f ms: %s", me.username, metrics.startup["total"] * 1000,
+            ", ".join(f"{k} {v * 1000:.0f}" for k, v in metrics.startup.items() if k != "total"),
+        )
+        if WEBHOOK_URL:
+            await run_webhook(bot)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await tenants.close()
+        await bot.session.close()
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())